@@ -1,8 +1,12 @@
 import argparse
 import json
 import re
+import sys
 
-from collections import namedtuple
+from annotation_store import load_parseme_annotations
+from collections import Counter, namedtuple, OrderedDict
+from compressed_io import open_input, open_output, STDIO
+from conllup_stats import add_stats_arguments, run_with_stats, stage
 
 
 SENTENCE_ID_RE = re.compile(r'(?<=(?:# sent_id = ))(.+)(?=\n)')
@@ -31,75 +35,169 @@ class CONLLUPToken(namedtuple('CONLLUPToken', ['index', 'form', 'lemma', 'upos',
         return '{}\n'.format('\t'.join(self))
 
 
-def add_annotations(input_stream, output_stream, annotation_data):
+MISMATCH_POLICIES = ['apply', 'skip', 'abort']
 
-    current_sentence_id = None
-    sentence = []
 
-    for line in input_stream:
-        if line.startswith('# sent_id'):
-            current_sentence_id = SENTENCE_ID_RE.search(line).group(0)
-            output_stream.write(line)
+class AnnotationMismatch(Exception):
+    pass
+
 
-        elif line.startswith('# '):
-            output_stream.write(line)
+class AnnotationReport:
+    # Alignment of the annotation data with the corpus: tokens whose form differs from the annotation data (or which
+    # are not in the sentence) by sentence and by MWE category, and annotated sentences not found in the corpus.
+
+    def __init__(self):
+        self.counts = Counter()
+        self.sentences = Counter()
+        self.categories = Counter()
+        self.found = set()
+
+    def add_mismatches(self, sentence_id, annotations, mismatches):
+        self.counts['sentences_mismatched'] += 1
+        self.counts['tokens_mismatched'] += len(mismatches)
+        self.sentences[sentence_id] += len(mismatches)
+        categories = mwe_categories(annotations)
+        for index, _, _ in mismatches:
+            for category in categories.get(index, ['*']):
+                self.categories[category] += 1
+
+    def missing(self, annotation_data):
+        return [sentence_id for sentence_id in annotation_data if sentence_id not in self.found]
+
+    def to_json(self, annotation_data):
+        return OrderedDict([('counts', OrderedDict(sorted(self.counts.items()))),
+                            ('sentences', OrderedDict(self.sentences.most_common())),
+                            ('categories', OrderedDict(self.categories.most_common())),
+                            ('missing_sentences', self.missing(annotation_data))])
+
+    def summary(self, annotation_data):
+        lines = ['{} of {} annotated sentences found, {} annotated.'.format(
+            len(self.found), len(annotation_data), self.counts['sentences_annotated'])]
+        if self.counts['tokens_mismatched']:
+            lines.append('{} token mismatches in {} sentences{}.'.format(
+                self.counts['tokens_mismatched'], self.counts['sentences_mismatched'],
+                ', {} sentences skipped'.format(self.counts['sentences_skipped'])
+                if self.counts['sentences_skipped'] else ''))
+            lines.append('Mismatches by MWE category: {}.'.format(
+                ', '.join('{} {}'.format(category, count) for category, count in self.categories.most_common())))
+        missing = len(annotation_data) - len(self.found)
+        if missing:
+            lines.append('{} annotated sentences missing from the corpus.'.format(missing))
+        return '\n'.join(lines)
+
+
+def mwe_categories(annotations):
+    # categories of the expressions of each token, expressions are numbered within the sentence and only their first
+    # token has the category (1:VID, then 1)
+    expressions = {}
+    for _, _, tag in annotations:
+        for code in tag.split(';'):
+            number, _, category = code.partition(':')
+            if category:
+                expressions[number] = category
+    return {index: sorted({expressions.get(code.partition(':')[0], '?') for code in tag.split(';')})
+            for index, _, tag in annotations if tag not in ('*', '_')}
+
+
+def apply_annotations(input_stream, output_stream, annotation_data, on_mismatch='apply', mismatch_log=None):
+    # Checks the forms of annotated tokens and, unless output_stream is None, writes the corpus with PARSEME:MWE of
+    # the annotated sentences replaced. A sentence with mismatches is annotated anyway, written unchanged (skip) or
+    # stops the run (abort). Only the tokens of annotated sentences are parsed, other lines are copied as they are.
+    report = AnnotationReport()
+    write = output_stream.write if output_stream is not None else lambda line: None
+    sentence_id = None
+    annotations = None
+    lines = []
+
+    def end_sentence():
+        report.found.add(sentence_id)
+        sentence = [line.strip().split('\t') for line in lines]
+        for columns in sentence:
+            if len(columns) != len(CONLLUPToken._fields):
+                raise InvalidCONLLUPToken('Invalid token. Expected 15 columns, got {}.'.format(len(columns)))
+        tags = {index: tag for index, _, tag in annotations}
+        forms = {columns[0]: columns[1] for columns in sentence}
+        mismatches = [(index, form, forms.get(index)) for index, form, _ in annotations if forms.get(index) != form]
+        if mismatches:
+            report.add_mismatches(sentence_id, annotations, mismatches)
+            if mismatch_log is not None:
+                for index, expected, found in mismatches:
+                    if found is None:
+                        print('Sentence {}. Token {} not found, expected {}.'.format(sentence_id, index, expected),
+                              file=mismatch_log)
+                    else:
+                        print('Sentence {}. Token mismatch. Expected {}, found {}.'.format(sentence_id, expected,
+                                                                                          found), file=mismatch_log)
+            if on_mismatch == 'abort':
+                raise AnnotationMismatch('Sentence {}: {} token mismatches.'.format(sentence_id, len(mismatches)))
+            if on_mismatch == 'skip':
+                report.counts['sentences_skipped'] += 1
+                write(''.join(lines))
+                return
+        report.counts['sentences_annotated'] += 1
+        for columns in sentence:
+            columns[13] = tags.get(columns[0], '*')
+        write(''.join('{}\n'.format('\t'.join(columns)) for columns in sentence))
+
+    for line in input_stream:
+        if line.startswith('# '):
+            if line.startswith('# sent_id'):
+                sentence_id = SENTENCE_ID_RE.search(line).group(0)
+                annotations = annotation_data.get(sentence_id)
+            write(line)
 
         elif not line.strip():
-            if current_sentence_id in annotation_data:
-                current_sentence_annotations = {a[0]: a[2] for a in annotation_data[current_sentence_id]['annotations']}
-                for i in range(len(sentence)):
-                    sentence[i] = CONLLUPToken.create_from_conllup_token(
-                        sentence[i],
-                        current_sentence_annotations.get(sentence[i].index, '*')
-                    )
-            for token in sentence:
-                output_stream.write(token.to_conllup_line())
-            current_sentence_id = None
-            sentence = []
-            output_stream.write(line)
+            if annotations is not None:
+                end_sentence()
+            sentence_id = None
+            annotations = None
+            lines = []
+            write(line)
+
+        elif annotations is not None:
+            lines.append(line)
 
         else:
-            sentence.append(CONLLUPToken.create_from_conllup_line(line.strip()))
+            write(line)
 
+    if annotations is not None:
+        end_sentence()
+    return report
 
-def test_annotations(input_stream, annotation_data):
 
-    current_sentence_id = None
-    sentence = []
+def add_annotations(input_stream, output_stream, annotation_data, on_mismatch='apply'):
+    return apply_annotations(input_stream, output_stream, annotation_data, on_mismatch)
 
-    for line in input_stream:
-        if line.startswith('# sent_id'):
-            current_sentence_id = SENTENCE_ID_RE.search(line).group(0)
 
-        elif line.startswith('# '):
-            continue
+def test_annotations(input_stream, annotation_data, on_mismatch='apply'):
+    return apply_annotations(input_stream, None, annotation_data, on_mismatch, mismatch_log=sys.stdout)
 
-        elif not line.strip():
-            if current_sentence_id in annotation_data:
-                current_sentence_annotations = {a[0]: a[1:] for a in annotation_data[current_sentence_id]['annotations']}
-                for token in sentence:
-                    if token.index in current_sentence_annotations:
-                        if token.form != current_sentence_annotations[token.index][0]:
-                            print("Sentence {}. Token mismatch. Expected {}, found {}.".format(
-                                current_sentence_id,
-                                current_sentence_annotations[token.index][0],
-                                token.form
-                            ))
-            current_sentence_id = None
-            sentence = []
-
-        else:
-            sentence.append(CONLLUPToken.create_from_conllup_line(line.strip()))
 
+def main(args, stats=None):
+    with stage(stats, 'load_annotations'), open_input(args.annotation_data) as f:
+        annotation_data = load_parseme_annotations(f, spill=args.spill)
+    with annotation_data:
+        if stats is not None:
+            stats.count('annotated_sentences', len(annotation_data))
+        try:
+            if args.test:
+                with open_input(args.source) as infile:
+                    report = test_annotations(infile, annotation_data, args.on_mismatch)
+            else:
+                with open_input(args.source) as infile, open_output(args.output_file) as outfile:
+                    report = add_annotations(infile, outfile if stats is None else stats.writer(outfile),
+                                             annotation_data, args.on_mismatch)
+        except AnnotationMismatch as e:
+            print('Aborted: {}'.format(e), file=sys.stderr)
+            return 1
 
-def main(args):
-    annotation_data = json.loads(open(args.annotation_data, 'r').read())
-    if args.test:
-        with open(args.source, 'r') as infile:
-                test_annotations(infile, annotation_data)
-    else:
-        with open(args.source, 'r') as infile, open(args.output_file, 'w') as outfile:
-            add_annotations(infile, outfile, annotation_data)
+        if stats is not None:
+            stats.update(report.counts)
+        if args.report:
+            with open(args.report, 'w', encoding='utf-8') as f:
+                json.dump(report.to_json(annotation_data), f, indent=2, ensure_ascii=False)
+        print(report.summary(annotation_data), file=sys.stderr)
+    return 0
 
 
 if __name__ == '__main__':
@@ -109,10 +207,20 @@ if __name__ == '__main__':
         description='Adds PARSEME:MWE annotations to CONLLUP file',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
-    parser.add_argument('source', help='Path to the source file.')
+    parser.add_argument('source', help='Path to the source file (compressed files are decompressed, - reads from '
+                                       'stdin).')
     parser.add_argument('annotation_data', help='Path to the annotation data .json file.')
-    parser.add_argument('-o', dest='output_file', help='Path to the output file.')
+    parser.add_argument('-o', dest='output_file', default=STDIO,
+                        help='Path to the output file (compressed by extension, - writes to stdout).')
     parser.add_argument('--test', dest='test', action='store_true',
                         help='Test the annotations.')
+    parser.add_argument('--on-mismatch', dest='on_mismatch', choices=MISMATCH_POLICIES, default='apply',
+                        help='What to do with a sentence whose token forms do not match the annotation data: annotate '
+                             'it anyway, write it unchanged or stop.')
+    parser.add_argument('--report', help='Path to a JSON report of mismatches by sentence and by MWE category and of '
+                                         'annotated sentences missing from the corpus.')
+    parser.add_argument('--spill', action='store_true',
+                        help='Keep the annotation data in a temporary file on disk instead of in memory.')
+    add_stats_arguments(parser)
     args = parser.parse_args()
-    main(args)
+    sys.exit(run_with_stats(main, args))
@@ -0,0 +1,215 @@
+import json
+import os
+import sqlite3
+import tempfile
+
+from compressed_io import open_input, strip_compression_extension
+
+
+JSON_WHITESPACE = ' \t\n\r'
+JSON_DELIMITERS = JSON_WHITESPACE + ',:]}'
+READ_SIZE = 1 << 16
+SPILL_BATCH = 10000
+
+
+class AnnotationStore:
+    # Token annotations of sentences by sentence id. The rows of a sentence (token index, form, value) are packed into
+    # one tab and newline separated string, which is kept in a dict or, when spilled, in an sqlite file on disk.
+
+    def __init__(self, spill=False):
+        self.sentences = None
+        self.database = None
+        self.filename = None
+        self.pending = []
+        if spill:
+            descriptor, self.filename = tempfile.mkstemp(suffix='.sqlite')
+            os.close(descriptor)
+            self.database = sqlite3.connect(self.filename)
+            self.database.execute('PRAGMA journal_mode = OFF')
+            self.database.execute('PRAGMA synchronous = OFF')
+            self.database.execute('CREATE TABLE sentences (id TEXT PRIMARY KEY, rows TEXT NOT NULL)')
+        else:
+            self.sentences = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.database is not None:
+            self.database.close()
+            self.database = None
+            os.remove(self.filename)
+
+    @staticmethod
+    def pack(rows):
+        return '\n'.join('\t'.join(str(column) for column in row) for row in rows)
+
+    @staticmethod
+    def unpack(packed):
+        return [tuple(row.split('\t')) for row in packed.split('\n')] if packed else []
+
+    def add(self, sentence_id, rows):
+        # a sentence added again replaces the previous rows, as a repeated key in a JSON object does
+        if self.database is None:
+            self.sentences[sentence_id] = self.pack(rows)
+            return
+        self.pending.append((sentence_id, self.pack(rows)))
+        if len(self.pending) >= SPILL_BATCH:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.database.executemany('INSERT OR REPLACE INTO sentences VALUES (?, ?)', self.pending)
+            self.database.commit()
+            self.pending = []
+
+    def packed(self, sentence_id):
+        if self.database is None:
+            return self.sentences.get(sentence_id)
+        self.flush()
+        row = self.database.execute('SELECT rows FROM sentences WHERE id = ?', (sentence_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def get(self, sentence_id):
+        # list of (index, form, value) tuples of the sentence, None for a sentence without annotation data
+        packed = self.packed(sentence_id)
+        return None if packed is None else self.unpack(packed)
+
+    def values(self, sentence_id):
+        # dict of values by token index, None for a sentence without annotation data
+        packed = self.packed(sentence_id)
+        if packed is None:
+            return None
+        return {row[0]: row[2] for row in self.unpack(packed)}
+
+    def __contains__(self, sentence_id):
+        return self.packed(sentence_id) is not None
+
+    def __len__(self):
+        if self.database is None:
+            return len(self.sentences)
+        self.flush()
+        return self.database.execute('SELECT COUNT(*) FROM sentences').fetchone()[0]
+
+    def __iter__(self):
+        if self.database is None:
+            return iter(self.sentences)
+        self.flush()
+        return (row[0] for row in self.database.execute('SELECT id FROM sentences'))
+
+
+def iter_json_object(input_stream, read_size=READ_SIZE):
+    # Yields the (key, value) pairs of the top level JSON object of the stream. Only one value is decoded at a time,
+    # the buffer holds the rest of the current read and the value being decoded.
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    eof = False
+
+    def read(size):
+        nonlocal buffer, position, eof
+        chunk = input_stream.read(size)
+        if not chunk:
+            eof = True
+        buffer = buffer[position:] + chunk
+        position = 0
+
+    def skip_whitespace():
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in JSON_WHITESPACE:
+                position += 1
+            if position < len(buffer) or eof:
+                return
+            read(read_size)
+
+    def expect(characters):
+        nonlocal position
+        skip_whitespace()
+        if position >= len(buffer) or buffer[position] not in characters:
+            raise json.JSONDecodeError('Expecting {}'.format(' or '.join(repr(c) for c in characters)), buffer,
+                                       position)
+        position += 1
+        return buffer[position - 1]
+
+    def decode():
+        # a value is complete once a delimiter follows it, a number at the end of a read may go on in the next one
+        nonlocal position
+        skip_whitespace()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+                if eof or end < len(buffer) and buffer[end] in JSON_DELIMITERS:
+                    position = end
+                    return value
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            # reading at least as much as is buffered keeps decoding of long values linear
+            read(max(read_size, len(buffer) - position))
+
+    expect('{')
+    skip_whitespace()
+    if position < len(buffer) and buffer[position] == '}':
+        return
+    while True:
+        key = decode()
+        if not isinstance(key, str):
+            raise json.JSONDecodeError('Expecting property name enclosed in double quotes', buffer, position)
+        expect(':')
+        yield key, decode()
+        if expect(',}') == '}':
+            return
+
+
+def load_parseme_annotations(input_stream, spill=False):
+    # reads the annotation data .json file of add_parseme_annotations.py sentence by sentence into a store
+    store = AnnotationStore(spill)
+    try:
+        for sentence_id, sentence in iter_json_object(input_stream):
+            store.add(sentence_id, sentence['annotations'])
+    except BaseException:
+        store.close()
+        raise
+    return store
+
+
+def load_tsv_annotations(input_stream, spill=False):
+    # Reads tab separated sentence id, token id, optional form and value lines into a store, the form is empty when
+    # it is not given. Lines of a sentence must be consecutive, empty lines and lines starting with # are skipped.
+    store = AnnotationStore(spill)
+    sentence_id = None
+    rows = []
+    try:
+        for line_no, line in enumerate(input_stream, 1):
+            if not line.strip() or line.startswith('#'):
+                continue
+            columns = line.rstrip('\r\n').split('\t')
+            if len(columns) == 3:
+                columns.insert(2, '')
+            elif len(columns) != 4:
+                raise ValueError('Line {}: expected 3 or 4 columns, got {}.'.format(line_no, len(columns)))
+            if columns[0] != sentence_id:
+                if sentence_id is not None:
+                    store.add(sentence_id, rows)
+                sentence_id = columns[0]
+                rows = []
+                if sentence_id in store:
+                    raise ValueError('Line {}: lines of sentence {} are not consecutive.'.format(line_no, sentence_id))
+            rows.append(columns[1:])
+        if sentence_id is not None:
+            store.add(sentence_id, rows)
+    except BaseException:
+        store.close()
+        raise
+    return store
+
+
+def open_annotations(filename, spill=False):
+    # loads a .tsv (also compressed) or a .json annotation data file into a store
+    tsv = strip_compression_extension(filename).endswith('.tsv')
+    with open_input(filename) as f:
+        return (load_tsv_annotations if tsv else load_parseme_annotations)(f, spill)
@@ -0,0 +1,280 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.synthetic_corpus import SyntheticCorpus
+from collections import OrderedDict
+from contextlib import ExitStack
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_VERSION = 1
+
+
+class Benchmark:
+    # A named entry point run on the corpus. setup is run before every repeat and not measured, run gets its result.
+    # Peak memory is measured in a separate run with tracemalloc, which would slow down the timed runs.
+
+    def __init__(self, name, run, setup=lambda: None, memory=True):
+        self.name = name
+        self.run = run
+        self.setup = setup
+        self.memory = memory
+
+    def measure(self, repeats):
+        timings = []
+        for _ in range(repeats):
+            state = self.setup()
+            start = time.perf_counter()
+            self.run(state)
+            timings.append(time.perf_counter() - start)
+
+        peak = None
+        if self.memory:
+            state = self.setup()
+            tracemalloc.start()
+            try:
+                self.run(state)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+        return timings, peak
+
+
+def corpus_benchmarks(corpus_file, workdir):
+    from add_parseme_annotations import add_annotations, test_annotations
+    from annotation_store import load_parseme_annotations
+    from conllup_cache import CONLLUPCorpus
+    from conllup_index import CONLLUPIndex
+    from conllup_reader import CONLLUPMappedReader
+    from conllup_validator import validate
+    from generate_conllu import generate, generate_parallel
+    from merge_annotations import Layer, merge_layers
+    from msd_mapper import MSDMapper
+
+    output_file = os.path.join(workdir, 'output.conllu')
+    annotation_file = os.path.join(workdir, 'annotations.json')
+    with open(annotation_file, 'w', encoding='utf-8') as f:
+        json.dump(parseme_annotations(corpus_file), f)
+    with open(annotation_file, 'r', encoding='utf-8') as f:
+        annotation_data = load_parseme_annotations(f)
+
+    def generate_to(**kwargs):
+        def run(state):
+            with CONLLUPMappedReader(corpus_file) as infile, open(output_file, 'w') as outfile:
+                generate(infile, outfile, **kwargs)
+        return run
+
+    def generate_splits(state):
+        with ExitStack() as stack:
+            infile = stack.enter_context(CONLLUPMappedReader(corpus_file))
+            outfiles = OrderedDict([(dataset, stack.enter_context(open(os.path.join(workdir, dataset), 'w')))
+                                    for dataset in ['synth-train', 'synth-dev', 'synth-test']])
+            generate(infile, outfiles)
+
+    def generate_jobs(state):
+        with open(output_file, 'w') as outfile:
+            generate_parallel(corpus_file, outfile, 2, index=state)
+
+    def map_words(mapper):
+        with open(corpus_file, 'r', encoding='utf-8') as infile:
+            for line in infile:
+                if line[:1] not in '#\n':
+                    columns = line.split('\t', 5)
+                    mapper.map_word(columns[1], columns[2], columns[4])
+
+    def map_many(mapper):
+        with open(corpus_file, 'r', encoding='utf-8') as infile:
+            tokens = [line.split('\t', 5) for line in infile if line[:1] not in '#\n']
+        mapper.map_many([t[1] for t in tokens], [t[2] for t in tokens], [t[4] for t in tokens])
+
+    def load_annotations(state):
+        with open(annotation_file, 'r', encoding='utf-8') as f:
+            load_parseme_annotations(f).close()
+
+    def add(state):
+        with open(corpus_file, 'r', encoding='utf-8') as infile, open(output_file, 'w') as outfile:
+            add_annotations(infile, outfile, annotation_data)
+
+    def merge(state):
+        with open(corpus_file, 'r', encoding='utf-8') as infile, open(output_file, 'w') as outfile:
+            merge_layers(infile, outfile, [Layer('PARSEME:MWE', annotation_file, annotation_data)])
+
+    def test(state):
+        with open(corpus_file, 'r', encoding='utf-8') as infile:
+            test_annotations(infile, annotation_data)
+
+    def validate_corpus(state):
+        with open(corpus_file, 'r', encoding='utf-8') as infile:
+            validate(infile)
+
+    def compile_cache(state):
+        CONLLUPCorpus.compile(corpus_file, os.path.join(workdir, 'corpus.cache')).close()
+
+    benchmarks = [
+        Benchmark('generate', generate_to()),
+        Benchmark('generate_filtered', generate_to(datasets={'synth-train'}, annotations={'NE'})),
+        Benchmark('generate_misc', generate_to(misc=['NE', 'DP', 'SRL', 'PARSEME', 'RMISC'])),
+        Benchmark('generate_splits', generate_splits),
+        Benchmark('generate_parallel', generate_jobs, setup=lambda: CONLLUPIndex.build(corpus_file), memory=False),
+        Benchmark('index_build', lambda state: CONLLUPIndex.build(corpus_file)),
+        Benchmark('cache_compile', compile_cache),
+        Benchmark('msd_map_word', map_words, setup=MSDMapper),
+        Benchmark('msd_map_many', map_many, setup=MSDMapper),
+        Benchmark('validate', validate_corpus),
+        Benchmark('load_annotations', load_annotations),
+        Benchmark('add_annotations', add),
+        Benchmark('merge_annotations', merge),
+        Benchmark('test_annotations', test),
+    ]
+
+    try:
+        from make_train_dev_test_split import CONLLCorpusDocumentIterator
+    except ImportError:
+        # the conll_corpus_splitter submodule is not checked out
+        pass
+    else:
+        benchmarks.append(Benchmark('document_iterator',
+                                    lambda state: sum(1 for _ in CONLLCorpusDocumentIterator(corpus_file))))
+
+    return benchmarks
+
+
+def parseme_annotations(corpus_file, every=10):
+    # annotation data of every n-th sentence in the format read by add_parseme_annotations.py
+    annotation_data = {}
+    sentence_id = None
+    count = 0
+    with open(corpus_file, 'r', encoding='utf-8') as infile:
+        for line in infile:
+            if line.startswith('# sent_id'):
+                count += 1
+                sentence_id = line.split(' = ', 1)[1].strip() if count % every == 0 else None
+                if sentence_id:
+                    annotation_data[sentence_id] = {'annotations': [], 'text': ''}
+            elif sentence_id and line[:1] not in '#\n':
+                columns = line.split('\t', 2)
+                if len(annotation_data[sentence_id]['annotations']) < 2:
+                    annotation_data[sentence_id]['annotations'].append([columns[0], columns[1], '1:VID'])
+    return annotation_data
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def corpus_stats(corpus_file):
+    tokens = 0
+    with open(corpus_file, 'rb') as f:
+        for line in f:
+            if line[:1] not in b'#\n':
+                tokens += 1
+    return os.path.getsize(corpus_file), tokens
+
+
+def run_benchmarks(corpus_file, workdir, repeats=3, only=None):
+    size, tokens = corpus_stats(corpus_file)
+    results = OrderedDict()
+    for benchmark in corpus_benchmarks(corpus_file, workdir):
+        if only and benchmark.name not in only:
+            continue
+        timings, peak = benchmark.measure(repeats)
+        best = min(timings)
+        results[benchmark.name] = {
+            'seconds': timings,
+            'best_seconds': best,
+            'mean_seconds': sum(timings) / len(timings),
+            'tokens_per_second': tokens / best if best else None,
+            'megabytes_per_second': size / best / (1 << 20) if best else None,
+            'peak_memory_bytes': peak
+        }
+        print('{:<20} {:>9.3f} s {:>12.0f} tokens/s {:>10} peak'.format(
+            benchmark.name, best, results[benchmark.name]['tokens_per_second'] or 0,
+            '-' if peak is None else '{:.1f} MB'.format(peak / (1 << 20))
+        ))
+    return size, tokens, results
+
+
+def compare(results, previous):
+    print()
+    print('{:<20} {:>10} {:>10} {:>8}'.format('benchmark', 'previous', 'current', 'speedup'))
+    for name, result in results['benchmarks'].items():
+        if name not in previous['benchmarks']:
+            continue
+        before = previous['benchmarks'][name]['best_seconds']
+        after = result['best_seconds']
+        print('{:<20} {:>9.3f}s {:>9.3f}s {:>7.2f}x'.format(name, before, after, before / after if after else 0))
+    if results['corpus'] != previous['corpus']:
+        print('Warning: the results were measured on different corpora.')
+
+
+def main(args):
+    corpus_options = OrderedDict([('documents', args.documents), ('sentences', args.sentences),
+                                  ('tokens', args.tokens), ('partial', args.partial),
+                                  ('annotations', args.annotations), ('msd_skew', args.msd_skew),
+                                  ('seed', args.seed)])
+
+    with tempfile.TemporaryDirectory() as workdir:
+        corpus_file = args.corpus
+        if not corpus_file:
+            corpus_file = os.path.join(workdir, 'synthetic.conllup')
+            with open(corpus_file, 'w', encoding='utf-8') as f:
+                SyntheticCorpus(**corpus_options).write(f)
+        size, tokens, benchmarks = run_benchmarks(corpus_file, workdir, args.repeats, args.only)
+
+    corpus = OrderedDict([('file', args.corpus)] if args.corpus else corpus_options)
+    corpus['bytes'] = size
+    corpus['tokens'] = tokens
+    results = OrderedDict([
+        ('version', RESULTS_VERSION),
+        ('commit', git_commit()),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('repeats', args.repeats),
+        ('corpus', corpus),
+        ('benchmarks', benchmarks),
+    ])
+
+    if args.output_file:
+        with open(args.output_file, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        prog='CONLLUP benchmarks',
+        description='Measures throughput and peak memory of the tools on a synthetic (or given) .conllup corpus.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('-o', dest='output_file', help='Path to the JSON results file.')
+    parser.add_argument('-c', '--compare', help='Path to a JSON results file of a previous run to compare with.')
+    parser.add_argument('-r', '--repeats', type=int, default=3, help='Number of timed runs of every benchmark.')
+    parser.add_argument('--only', nargs='*', help='Run only these benchmarks.')
+    parser.add_argument('--corpus', help='Use this .conllup file instead of a synthetic corpus.')
+    parser.add_argument('-D', '--documents', type=int, default=200, help='Number of documents.')
+    parser.add_argument('-S', '--sentences', type=int, default=20, help='Mean number of sentences per document.')
+    parser.add_argument('-T', '--tokens', type=int, default=15, help='Mean number of tokens per sentence.')
+    parser.add_argument('-p', '--partial', type=float, default=0.1,
+                        help='Share of documents partially contained in datasets.')
+    parser.add_argument('-a', '--annotations', type=float, default=0.5,
+                        help='Probability of each annotation level in a document.')
+    parser.add_argument('-k', '--msd-skew', type=float, default=1.0,
+                        help='Zipf exponent of the MSD frequencies (0 for uniform).')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Random seed of the synthetic corpus.')
+    args = parser.parse_args()
+    main(args)
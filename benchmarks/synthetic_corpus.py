@@ -0,0 +1,152 @@
+import argparse
+import random
+
+from compressed_io import open_output
+from msd_mapper import DEFAULT_MAPPING
+
+
+COLUMNS = 'ID FORM LEMMA UPOS XPOS FEATS HEAD DEPREL DEPS MISC RELDI:NE RELDI:DP RELDI:SRL PARSEME:MWE RELDI:MISC'
+DATASETS = ['synth-train', 'synth-dev', 'synth-test']
+ANNOTATION_LEVELS = ['NE', 'DP', 'SRL', 'PARSEME']
+NE_TYPES = ['per', 'loc', 'org']
+DEPRELS = ['nsubj', 'obj', 'obl', 'amod', 'det', 'case', 'advmod', 'aux', 'cc', 'conj', 'punct', 'nmod']
+SRL_TAGS = ['ACT', 'PAT', 'LOC', 'TIME', 'MANN']
+PARSEME_TAGS = ['LVC.full', 'IRV', 'VID']
+SYLLABLES = ['ba', 'ko', 'vi', 'ne', 'sta', 'pri', 'lu', 'dra', 'mo', 'zi', 'če', 'šu', 'ja', 'ti', 'go', 'ro']
+
+
+def load_msds(mapping=DEFAULT_MAPPING):
+    # (msd, upos, feats) of every entry of the mapping
+    msds = []
+    with open(mapping, 'r', encoding='utf-8') as mapfile:
+        for line in mapfile:
+            parts = line.strip().split('\t')
+            msds.append((parts[0], parts[1], parts[3]))
+    return msds
+
+
+class SyntheticCorpus:
+    # Seeded generator of .conllup corpora with the structure of the ReLDI corpora. A share of the documents is only
+    # partially contained in datasets (marked with * and split by sentence), every document has a random subset of
+    # the annotation levels and MSDs are drawn from the mapping with Zipf-like frequencies (msd_skew=0 is uniform).
+
+    def __init__(self, documents=100, sentences=20, tokens=15, partial=0.1, annotations=0.5, msd_skew=1.0,
+                 datasets=DATASETS, seed=0, mapping=DEFAULT_MAPPING):
+        self.documents = documents
+        self.sentences = sentences
+        self.tokens = tokens
+        self.partial = partial
+        self.annotations = annotations
+        self.datasets = datasets
+        self.random = random.Random(seed)
+
+        self.msds = load_msds(mapping)
+        self.random.shuffle(self.msds)
+        self.msd_weights = [1 / (rank ** msd_skew) for rank in range(1, len(self.msds) + 1)]
+        self.vocabulary = [''.join(self.random.choice(SYLLABLES) for _ in range(self.random.randint(1, 4)))
+                           for _ in range(5000)]
+
+    def length(self, mean):
+        # count around the mean, at least 1
+        return max(1, int(self.random.gauss(mean, mean / 3)))
+
+    def entities(self, count):
+        # well-formed BIO tags, an entity starts at about every 10th token and continues with probability 0.3
+        tags = []
+        for _ in range(count):
+            if tags and tags[-1] != 'O' and self.random.random() < 0.3:
+                tags.append('I-' + tags[-1][2:])
+            elif self.random.random() < 0.1:
+                tags.append('B-' + self.random.choice(NE_TYPES))
+            else:
+                tags.append('O')
+        return tags
+
+    def expressions(self, count):
+        # PARSEME:MWE codes of a sentence with a two token expression in about every 4th sentence
+        codes = ['*'] * count
+        if count > 1 and self.random.random() < 0.25:
+            first, second = sorted(self.random.sample(range(count), 2))
+            codes[first] = '1:' + self.random.choice(PARSEME_TAGS)
+            codes[second] = '1'
+        return codes
+
+    def token_line(self, index, count, msd, levels, ne, parseme):
+        msd, upos, feats = msd
+        lemma = self.random.choice(self.vocabulary)
+        form = lemma + self.random.choice(['', 'a', 'om', 'i', 'ima'])
+        head = '0' if index == 1 else str(self.random.randint(1, count))
+        deprel = 'root' if index == 1 else self.random.choice(DEPRELS)
+        misc = 'SpaceAfter=No' if index == count - 1 else '_'
+        ne = ne if 'NE' in levels else 'O'
+        dp = '{}:{}'.format(head, deprel) if 'DP' in levels else '_'
+        srl = self.random.choice(SRL_TAGS) if 'SRL' in levels and self.random.random() < 0.2 else '_'
+        parseme = parseme if 'PARSEME' in levels else '*'
+        return '\t'.join([str(index), form, lemma, upos, msd, feats, head, deprel, '_', misc, ne, dp, srl, parseme,
+                          'Tokenizer=synthetic']) + '\n'
+
+    def document_lines(self, doc_no):
+        document_id = 'synth.doc{}'.format(doc_no)
+        dataset = self.random.choice(self.datasets)
+        partial = self.random.random() < self.partial
+        if partial:
+            datasets = sorted(self.random.sample(self.datasets, 2))
+            status = ';'.join('{}*'.format(d) for d in datasets)
+        else:
+            status = dataset
+        levels = [level for level in ANNOTATION_LEVELS if self.random.random() < self.annotations]
+
+        yield '# newdoc id = {}\n'.format(document_id)
+        yield '# contained_in_datasets = {}\n'.format(status)
+        yield '# annotation_levels = {}\n'.format(';'.join(levels) or '_')
+        for sent_no in range(self.length(self.sentences)):
+            count = self.length(self.tokens)
+            msds = self.random.choices(self.msds, weights=self.msd_weights, k=count)
+            tokens = [self.token_line(i, count, msd, levels, ne, parseme) for i, (msd, ne, parseme) in
+                      enumerate(zip(msds, self.entities(count), self.expressions(count)), 1)]
+            yield '# sent_id = {}.s{}\n'.format(document_id, sent_no)
+            if partial:
+                yield '# contained_in_datasets = {}\n'.format(self.random.choice(datasets))
+            yield '# text = {}\n'.format(' '.join(line.split('\t', 2)[1] for line in tokens))
+            for line in tokens:
+                yield line
+            yield '\n'
+
+    def lines(self):
+        yield '# global.columns = {}\n'.format(COLUMNS)
+        for doc_no in range(self.documents):
+            for line in self.document_lines(doc_no):
+                yield line
+
+    def write(self, output_stream):
+        for line in self.lines():
+            output_stream.write(line)
+
+
+def main(args):
+    corpus = SyntheticCorpus(args.documents, args.sentences, args.tokens, args.partial, args.annotations,
+                             args.msd_skew, seed=args.seed)
+    with open_output(args.output_file) as f:
+        corpus.write(f)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        prog='Synthetic CONLLUP corpus',
+        description='Generates a reproducible synthetic .conllup corpus for benchmarking.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('output_file', help='Path to the output file (compressed by extension, - writes to stdout).')
+    parser.add_argument('-D', '--documents', type=int, default=100, help='Number of documents.')
+    parser.add_argument('-S', '--sentences', type=int, default=20, help='Mean number of sentences per document.')
+    parser.add_argument('-T', '--tokens', type=int, default=15, help='Mean number of tokens per sentence.')
+    parser.add_argument('-p', '--partial', type=float, default=0.1,
+                        help='Share of documents partially contained in datasets.')
+    parser.add_argument('-a', '--annotations', type=float, default=0.5,
+                        help='Probability of each annotation level in a document.')
+    parser.add_argument('-k', '--msd-skew', type=float, default=1.0,
+                        help='Zipf exponent of the MSD frequencies (0 for uniform).')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Random seed.')
+    args = parser.parse_args()
+    main(args)
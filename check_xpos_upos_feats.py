@@ -1,37 +1,180 @@
 import argparse
+import json
 import os
 
+from compressed_io import is_plain_file, open_input, open_output, strip_compression_extension, STDIO
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from conllup_cache import CONLLUPCorpus
+from conllup_reader import CONLLUPMappedReader
+from conllup_stats import add_stats_arguments, run_with_stats, stage
 from msd_mapper import MSDMapper
 from generate_conllu import CONLLUPToken
+from itertools import islice
 
 mapper = MSDMapper()
+BATCH_SIZE = 10000
+MISMATCH_COUNTERS = {'UPOS': 'upos_mismatches', 'XPOS': 'xpos_mismatches', 'LAST RESORT': 'last_resort'}
+TUPLE_COLUMNS = ['form', 'lemma', 'msd', 'upos', 'upos_feats']
 
 
-def main(args):
+def mismatch(msd, token_upos, token_feats, upos, udfeat):
+    # fields of the reported mismatch of the token and its mapped UPOS and features, None if they agree
+    if token_upos == upos and token_feats == udfeat:
+        return None
+    upos_tag = '{}|{}'.format(token_upos, token_feats)
+    if upos_tag not in mapper.uposudfeat_msd:
+        return 'UPOS', msd, 'UposTag={}'.format(upos_tag)
+    if msd not in mapper.uposudfeat_msd[upos_tag]:
+        return 'XPOS', msd, upos_tag
+    return 'LAST RESORT',
+
+
+def check_lines(lines, f, counts):
+    # maps the tokens of the lines at once and writes the lines, marking mismatched tokens
+    counts['lines_read'] += len(lines)
+    tokens = [None if line.startswith('#') or line.startswith('\n') or '-' in line.split('\t')[0]
+              else CONLLUPToken(*line.strip().split('\t')) for line in lines]
+    mapped = [t for t in tokens if t is not None]
+    mapped = iter(mapper.map_many([t.form for t in mapped], [t.lemma for t in mapped], [t.msd for t in mapped]))
+
+    for line, token in zip(lines, tokens):
+        if token is None:
+            f.write(line)
+            continue
+        counts['tokens'] += 1
+        mtefeat, upos, udfeat = next(mapped)
+        fields = mismatch(token.msd, token.upos, token.upos_feats, upos, udfeat)
+        if fields is None:
+            f.write(line)
+            continue
+        counts[MISMATCH_COUNTERS[fields[0]]] += 1
+        print(*fields)
+        f.write(line if fields[0] == 'LAST RESORT' else '{}!!!\t{}'.format(fields[0], line))
+
+
+def count_token_lines(lines, tuples):
+    # counts the (form, lemma, msd, upos, feats) tuples of the token lines
+    for line in lines:
+        if line[:1] in '#\n':
+            continue
+        index, form, lemma, upos, msd, feats = line.split('\t', 6)[:6]
+        if '-' not in index:
+            tuples[form, lemma, msd, upos, feats] += 1
+    return tuples
+
+
+def count_range(source, start, end):
+    # token tuples of the byte range of whole lines of the source file, run in the worker processes
+    tuples = Counter()
+    with CONLLUPMappedReader(source) as reader:
+        while start < end:
+            block_end = min(reader.block_end(start), end)
+            count_token_lines(reader.read_lines(start, block_end), tuples)
+            start = block_end
+    return tuples
+
+
+def count_cached(corpus):
+    # token tuples counted over the integer codes of the cached corpus, decoded once per distinct tuple
+    skipped = {code for code, index in enumerate(corpus.table('index')) if '-' in index}
+    indices = corpus.codes('index')
+    codes = Counter(key for index, key in zip(indices, zip(*[corpus.codes(name) for name in TUPLE_COLUMNS]))
+                    if index not in skipped)
+    tables = [corpus.table(name) for name in TUPLE_COLUMNS]
+    return Counter({tuple(table[code] for table, code in zip(tables, key)): count for key, count in codes.items()})
+
+
+def check_tuples(tuples):
+    # mismatch counts and counters of the token tuples
+    counts = Counter({'tokens': sum(tuples.values()), 'distinct_tokens': len(tuples)})
+    return aggregate_mismatches(tuples, counts), counts
+
+
+def check_range(source, start, end):
+    # run in the worker processes, which return only the small mismatch counts instead of all the token tuples
+    return check_tuples(count_range(source, start, end))
+
+
+def check_source(source, jobs=1):
+    # mismatch counts of the source, checked in parallel over line-aligned byte ranges of an uncompressed file
+    if not is_plain_file(source):
+        with open_input(source) as infile:
+            return check_tuples(count_token_lines(infile, Counter()))
+
+    corpus = CONLLUPCorpus.load(source)
+    if corpus is not None:
+        with corpus:
+            return check_tuples(count_cached(corpus))
+
+    with CONLLUPMappedReader(source) as reader:
+        ranges = reader.ranges(jobs)
+    if len(ranges) < 2:
+        return check_tuples(count_range(source, *ranges[0]) if ranges else Counter())
+    mismatches = Counter()
+    counts = Counter()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for shard_mismatches, shard_counts in executor.map(check_range, *zip(*[(source, start, end)
+                                                                               for start, end in ranges])):
+            mismatches.update(shard_mismatches)
+            counts.update(shard_counts)
+    return mismatches, counts
+
+
+def aggregate_mismatches(tuples, counts=None):
+    # counts of the distinct mismatches, each distinct token tuple is mapped and checked once
+    keys = list(tuples)
+    mapped = mapper.map_many([k[0] for k in keys], [k[1] for k in keys], [k[2] for k in keys])
+    mismatches = Counter()
+    for key, (mtefeat, upos, udfeat) in zip(keys, mapped):
+        fields = mismatch(key[2], key[3], key[4], upos, udfeat)
+        if fields is not None:
+            mismatches[' '.join(fields)] += tuples[key]
+            if counts is not None:
+                counts[MISMATCH_COUNTERS[fields[0]]] += tuples[key]
+    return mismatches
+
+
+def aggregate(args, stats=None):
+    mismatches = Counter()
+    counts = Counter()
+    with stage(stats, 'check'):
+        for source in args.source:
+            source_mismatches, source_counts = check_source(source, args.jobs)
+            mismatches.update(source_mismatches)
+            counts.update(source_counts)
+
+    # same lines as piping the mismatches of the annotating mode to sort | uniq -c
+    for mismatch_line in sorted(mismatches):
+        print('{:>7} {}'.format(mismatches[mismatch_line], mismatch_line))
+    if args.json_file:
+        with open(args.json_file, 'w') as f:
+            json.dump(OrderedDict(sorted(mismatches.items())), f, indent=2, ensure_ascii=False)
+
+    if stats is not None:
+        stats.update(counts)
+
+
+def main(args, stats=None):
+    if args.aggregate:
+        aggregate(args, stats)
+        return
+
+    args.source = args.source[0]
     output_filename = args.output_file
     if not output_filename:
-        output_filename = '{}.uposxpos.txt'.format(os.path.splitext(args.source)[0])
-
-    with open(output_filename, 'w') as f:
-        for line in open(args.source, 'r'):
-            if line.startswith('#') or line.startswith('\n') or '-' in line.split('\t')[0]:
-                f.write(line)
-                continue
-            token = CONLLUPToken(*line.strip().split('\t'))
-            mtefeat, upos, udfeat = mapper.map_word(token.form, token.lemma, token.msd)
-            if token.upos == upos and token.upos_feats == udfeat:
-                f.write(line)
-                continue
-            upos_tag = '{}|{}'.format(token.upos, token.upos_feats)
-            if upos_tag not in mapper.uposudfeat_msd:
-                print('UPOS', token.msd, 'UposTag={}'.format(upos_tag))
-                f.write('UPOS!!!\t'+line)
-            elif token.msd not in mapper.uposudfeat_msd[upos_tag]:
-                    print('XPOS', token.msd, upos_tag)
-                    f.write('XPOS!!!\t'+line)
-            else:
-                print('LAST RESORT')
-                f.write(line)
+        output_filename = '{}.uposxpos.txt'.format(os.path.splitext(strip_compression_extension(args.source))[0])
+
+    counts = Counter()
+    with open_input(args.source) as infile, open_output(output_filename) as f:
+        if stats is not None:
+            f = stats.writer(f)
+        infile = iter(infile)
+        for lines in iter(lambda: list(islice(infile, BATCH_SIZE)), []):
+            check_lines(lines, f, counts)
+
+    if stats is not None:
+        stats.update(counts)
 
 
 if __name__ == '__main__':
@@ -41,7 +184,24 @@ if __name__ == '__main__':
         description='Validates mapping of XPOS to UPOS+Feats tags in a CONLLUP corpus.',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
-    parser.add_argument('source', help='Path to the source file.')
-    parser.add_argument('-o', '--output', dest='output_file', help='Path to the output file.')
+    parser.add_argument('source', nargs='+', help='Path to the source file (compressed files are decompressed, - '
+                                                  'reads from stdin). Several files can be aggregated at once.')
+    parser.add_argument('-o', '--output', dest='output_file', help='Path to the output file (compressed by '
+                                                                   'extension).')
+    parser.add_argument('-a', '--aggregate', action='store_true',
+                        help='Print the counts of the distinct mismatches instead of writing the annotated copy of '
+                             'the source. Each distinct token is checked only once.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes counting the tokens of an uncompressed source in aggregate mode.')
+    parser.add_argument('--json', dest='json_file', help='Also write the mismatch counts to this JSON file in '
+                                                         'aggregate mode.')
+    add_stats_arguments(parser)
     args = parser.parse_args()
-    main(args)
+    if not args.aggregate:
+        if len(args.source) > 1:
+            parser.error('only one source can be given without -a/--aggregate')
+        if args.source[0] == STDIO and not args.output_file:
+            parser.error('argument -o/--output is required when reading from stdin')
+    if args.jobs < 1:
+        parser.error('argument -j/--jobs must be at least 1')
+    run_with_stats(main, args)
@@ -0,0 +1,124 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import sys
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+STDIO = '-'
+
+COMPRESSION_EXTENSIONS = {
+    '.gz': 'gzip',
+    '.bz2': 'bz2',
+    '.xz': 'xz',
+    '.lzma': 'xz',
+    '.zst': 'zstd',
+}
+
+COMPRESSION_MAGIC = [
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+]
+
+
+def compression_from_extension(filename):
+    return COMPRESSION_EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+
+
+def compression_from_magic(raw):
+    head = raw.peek(8)[:8]
+    for magic, compression in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def strip_compression_extension(filename):
+    if compression_from_extension(filename):
+        return os.path.splitext(filename)[0]
+    return filename
+
+
+def is_plain_file(filename):
+    # regular uncompressed file, which can be memory-mapped and seeked by byte offsets
+    if filename == STDIO or compression_from_extension(filename) or not os.path.isfile(filename):
+        return False
+    with open(filename, 'rb') as raw:
+        return compression_from_magic(raw) is None
+
+
+def require_zstandard():
+    if zstandard is None:
+        raise ImportError('Reading and writing .zst files requires the zstandard package (pip install zstandard).')
+
+
+def decompress(raw, compression):
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=raw, mode='rb')
+    if compression == 'bz2':
+        return bz2.BZ2File(raw, mode='rb')
+    if compression == 'xz':
+        return lzma.LZMAFile(raw, mode='rb')
+    if compression == 'zstd':
+        require_zstandard()
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, closefd=True))
+    return raw
+
+
+def compress(raw, compression):
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=raw, mode='wb')
+    if compression == 'bz2':
+        return bz2.BZ2File(raw, mode='wb')
+    if compression == 'xz':
+        return lzma.LZMAFile(raw, mode='wb')
+    if compression == 'zstd':
+        require_zstandard()
+        return zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+    return raw
+
+
+class ClosingStream(io.TextIOWrapper):
+    # text stream over a compressed stream, closing it closes also the underlying file
+    def __init__(self, stream, raw, **kwargs):
+        super().__init__(stream, **kwargs)
+        self.raw_file = raw
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.raw_file.close()
+
+
+def open_input(filename, encoding='utf-8'):
+    # opens plain, gzip, bz2, xz or zstd compressed file (detected by magic bytes) or stdin for '-' for reading text
+    if filename == STDIO:
+        raw = open(sys.stdin.fileno(), 'rb', closefd=False)
+    else:
+        raw = open(filename, 'rb')
+
+    compression = compression_from_magic(raw)
+    if compression is None:
+        return io.TextIOWrapper(raw, encoding=encoding)
+    return ClosingStream(decompress(raw, compression), raw, encoding=encoding)
+
+
+def open_output(filename, encoding='utf-8'):
+    # opens plain or compressed file (chosen by extension) or stdout for '-' for writing text
+    if filename == STDIO:
+        return io.TextIOWrapper(open(sys.stdout.fileno(), 'wb', closefd=False), encoding=encoding)
+
+    raw = open(filename, 'wb')
+    compression = compression_from_extension(filename)
+    if compression is None:
+        return io.TextIOWrapper(raw, encoding=encoding)
+    return ClosingStream(compress(raw, compression), raw, encoding=encoding)
@@ -0,0 +1,257 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+from array import array
+from conllup_index import file_hash
+
+
+CACHE_VERSION = 1
+CACHE_EXTENSION = '.cache'
+CACHE_MAGIC = b'CONLLUPC'
+HEADER_STRUCT = struct.Struct('<8sI')
+
+COLUMNS = ['index', 'form', 'lemma', 'upos', 'msd', 'upos_feats', 'head', 'deprel', 'deps', 'misc', 'ne', 'dp', 'srl',
+           'parseme_mwe', 'rmisc']
+DOCUMENT_STATUS_MARKS = ('# newdoc', '# contained_in_datasets', '# annotation_levels')
+
+
+def cache_filename(source):
+    return '{}{}'.format(source, CACHE_EXTENSION)
+
+
+class CONLLUPCorpusCompiler:
+    # Parses a .conllup file into interned string tables and integer-coded column arrays. All non-token lines are kept
+    # in order as metadata, each document and sentence points to the metadata lines that precede it.
+
+    def __init__(self):
+        self.tables = [{} for _ in COLUMNS]
+        self.columns = [array('I') for _ in COLUMNS]
+        self.metadata_table = {}
+        self.metadata = array('I')
+        # end of metadata before the first document
+        self.preamble_metadata = array('I', [0])
+        # start of the metadata (the # newdoc line) and of the sentences of each document
+        self.document_metadata = array('I')
+        self.document_sentences = array('I')
+        # end of the metadata before the tokens, start of the tokens and line number of the first token of each sentence
+        self.sentence_metadata = array('I')
+        self.sentence_tokens = array('I')
+        self.sentence_lines = array('I')
+
+    def compile(self, input_stream):
+        sha1 = hashlib.sha1()
+        size = 0
+        in_sentence = False
+        columns = list(zip(self.tables, self.columns))
+        metadata_table = self.metadata_table
+        metadata = self.metadata
+
+        for line_no, line in enumerate(input_stream, 1):
+            raw = line.encode('utf-8')
+            sha1.update(raw)
+            size += len(raw)
+            line = line[:-1] if line.endswith('\n') else line
+
+            if line.startswith('#'):
+                in_sentence = False
+                if line.startswith('# newdoc'):
+                    self.document_metadata.append(len(metadata))
+                    self.document_sentences.append(len(self.sentence_tokens))
+                metadata.append(metadata_table.setdefault(line, len(metadata_table)))
+                if not self.document_metadata:
+                    self.preamble_metadata[0] = len(metadata)
+
+            elif not line.strip():
+                in_sentence = False
+
+            else:
+                if not in_sentence:
+                    self.sentence_metadata.append(len(metadata))
+                    self.sentence_tokens.append(len(self.columns[0]))
+                    self.sentence_lines.append(line_no)
+                    in_sentence = True
+                values = line.split('\t')
+                if len(values) != len(COLUMNS):
+                    raise TypeError('Line number {}: Invalid token. Expected 15 columns, got {}.'.format(
+                        line_no, len(values)
+                    ))
+                for (table, column), value in zip(columns, values):
+                    column.append(table.setdefault(value, len(table)))
+
+        # closing boundaries
+        self.document_metadata.append(len(metadata))
+        self.document_sentences.append(len(self.sentence_tokens))
+        self.sentence_metadata.append(len(metadata))
+        self.sentence_tokens.append(len(self.columns[0]))
+        self.sentence_lines.append(0)
+        return size, sha1.hexdigest()
+
+    def save(self, filename, source=None, size=0, mtime=0, sha1=None):
+        sections = []
+        for name, table in zip(COLUMNS, self.tables):
+            sections.append(('table.{}'.format(name), '\n'.join(table).encode('utf-8'), 's'))
+        for name, column in zip(COLUMNS, self.columns):
+            sections.append(('column.{}'.format(name), column.tobytes(), 'I'))
+        sections.append(('table.metadata', '\n'.join(self.metadata_table).encode('utf-8'), 's'))
+        for name in ['metadata', 'preamble_metadata', 'document_metadata', 'document_sentences', 'sentence_metadata',
+                     'sentence_tokens', 'sentence_lines']:
+            sections.append((name, getattr(self, name).tobytes(), 'I'))
+
+        header = {'version': CACHE_VERSION, 'source': source, 'size': size, 'mtime': mtime, 'sha1': sha1,
+                  'tables': {name: len(table) for name, table in zip(COLUMNS, self.tables)},
+                  'sections': {}}
+        header['tables']['metadata'] = len(self.metadata_table)
+        offset = 0
+        for name, data, typecode in sections:
+            header['sections'][name] = [offset, len(data), typecode]
+            offset += len(data) + (-len(data) % 8)
+
+        header = json.dumps(header).encode('utf-8')
+        header += b' ' * (-(HEADER_STRUCT.size + len(header)) % 8)
+        with open(filename, 'wb') as f:
+            f.write(HEADER_STRUCT.pack(CACHE_MAGIC, len(header)))
+            f.write(header)
+            for name, data, typecode in sections:
+                f.write(data)
+                f.write(b'\0' * (-len(data) % 8))
+
+
+class CONLLUPCorpus:
+    # Memory-mapped columnar cache of a .conllup corpus. Integer arrays are memoryviews into the mapped file, string
+    # tables are decoded on first use.
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_length = HEADER_STRUCT.unpack_from(self.map)
+        if magic != CACHE_MAGIC:
+            raise ValueError('{} is not a CONLLUP corpus cache.'.format(filename))
+        self.header = json.loads(self.map[HEADER_STRUCT.size:HEADER_STRUCT.size + header_length].decode('utf-8'))
+        self.data_offset = HEADER_STRUCT.size + header_length
+        self.tables = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        try:
+            self.map.close()
+        except BufferError:
+            # column views are still in use, the map is closed when they are released
+            pass
+
+    @staticmethod
+    def compile(source, filename=None):
+        compiler = CONLLUPCorpusCompiler()
+        stat = os.stat(source)
+        with open(source, 'r', encoding='utf-8', newline='') as infile:
+            size, sha1 = compiler.compile(infile)
+        filename = filename or cache_filename(source)
+        compiler.save(filename, os.path.abspath(source), size, stat.st_mtime_ns, sha1)
+        return CONLLUPCorpus(filename)
+
+    @staticmethod
+    def load(source, filename=None):
+        # returns the cache of the source file if it exists and is up to date, None otherwise
+        filename = filename or cache_filename(source)
+        try:
+            corpus = CONLLUPCorpus(filename)
+        except (OSError, ValueError):
+            return None
+        if not corpus.is_fresh(source):
+            corpus.close()
+            return None
+        return corpus
+
+    def is_fresh(self, source):
+        stat = os.stat(source)
+        if self.header['version'] != CACHE_VERSION or stat.st_size != self.header['size']:
+            return False
+        return stat.st_mtime_ns == self.header['mtime'] or file_hash(source) == self.header['sha1']
+
+    def section(self, name):
+        offset, length, typecode = self.header['sections'][name]
+        view = memoryview(self.map)[self.data_offset + offset:self.data_offset + offset + length]
+        if typecode == 's':
+            return view
+        return view.cast(typecode)
+
+    def table(self, name):
+        if name not in self.tables:
+            data = bytes(self.section('table.{}'.format(name))).decode('utf-8')
+            self.tables[name] = data.split('\n') if self.header['tables'][name] else []
+        return self.tables[name]
+
+    def codes(self, name):
+        return self.section('column.{}'.format(name))
+
+    def column(self, name):
+        table = self.table(name)
+        return [table[code] for code in self.codes(name)]
+
+    def __len__(self):
+        return len(self.codes(COLUMNS[0]))
+
+    @property
+    def sentence_count(self):
+        return len(self.section('sentence_tokens')) - 1
+
+    @property
+    def document_count(self):
+        return len(self.section('document_sentences')) - 1
+
+    def metadata_lines(self, start, end):
+        table = self.table('metadata')
+        return [table[code] for code in self.section('metadata')[start:end]]
+
+    def document_status(self, document):
+        # the # newdoc line and the status lines following it
+        lines = self.metadata_lines(self.section('document_metadata')[document], self.section('document_metadata')[-1])
+        status = [lines[0]]
+        for line in lines[1:]:
+            if not line.startswith(DOCUMENT_STATUS_MARKS[1:]):
+                break
+            status.append(line)
+        return status
+
+    def sentence_range(self, sentence):
+        tokens = self.section('sentence_tokens')
+        return tokens[sentence], tokens[sentence + 1]
+
+
+def main(args):
+    if args.command == 'compile':
+        corpus = CONLLUPCorpus.compile(args.source, args.output_file)
+    else:
+        corpus = CONLLUPCorpus.load(args.source, args.output_file)
+        if corpus is None:
+            print('{}: missing or out of date'.format(args.output_file or cache_filename(args.source)))
+            return
+
+    with corpus:
+        print('{}: {} documents, {} sentences, {} tokens, {} distinct forms, {} distinct lemmas'.format(
+            corpus.filename, corpus.document_count, corpus.sentence_count, len(corpus),
+            len(corpus.table('form')), len(corpus.table('lemma'))
+        ))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        prog='CONLLUP corpus cache',
+        description='Compiles a .conllup corpus into a memory-mappable columnar binary cache.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('command', choices=['compile', 'info'], help='Command to run.')
+    parser.add_argument('source', help='Path to the source .conllup file.')
+    parser.add_argument('-o', dest='output_file', help='Path to the cache file (default: <source>.cache).')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,187 @@
+import re
+
+
+FILTER_SECTIONS = ('datasets', 'annotations')
+TOKEN_RE = re.compile(r'\s*(?:([()|&!])|([^\s()|&!;:]+))')
+
+
+class InvalidFilterExpression(ValueError):
+    pass
+
+
+class CONLLUPFilter:
+    # Predicate over the datasets or annotation levels of a document or sentence, compiled from a boolean expression.
+    # Every name of the expression is given a bit, a list of names is turned into a bitmask only once per distinct
+    # list and the expression is evaluated with integer operations. Names not in the expression are ignored, dataset
+    # names are matched without the trailing * of partially contained documents.
+
+    def __init__(self, code, bits):
+        self.code = code
+        self.bits = bits
+        self.predicate = eval('lambda m: {}'.format(code))
+        self.masks = {}
+        # whether a document (or sentence) in none of the datasets passes, i.e. the filter only omits
+        self.accepts_empty = self.predicate(0)
+
+    def mask(self, names):
+        key = tuple(names)
+        mask = self.masks.get(key)
+        if mask is None:
+            mask = 0
+            for name in names:
+                mask |= self.bits.get(name.strip('*'), 0)
+            self.masks[key] = mask
+        return mask
+
+    def __call__(self, names):
+        return self.predicate(self.mask(names))
+
+    def __and__(self, other):
+        bits = dict(self.bits)
+        for name in other.bits:
+            bits.setdefault(name, 1 << len(bits))
+        return CONLLUPFilter('({}) and ({})'.format(rebase(self.code, self.bits, bits),
+                                                    rebase(other.code, other.bits, bits)), bits)
+
+
+def rebase(code, bits, new_bits):
+    # rewrites bit tests of the code from one vocabulary to another
+    codes = {bit: new_bits[name] for name, bit in bits.items()}
+    return re.sub(r'm & (\d+)', lambda match: 'm & {}'.format(codes[int(match.group(1))]), code)
+
+
+def tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = TOKEN_RE.match(expression, position)
+        if not match:
+            raise InvalidFilterExpression('Unexpected character {!r} at position {} of {!r}.'.format(
+                expression[position], position, expression
+            ))
+        tokens.append(match.group(1) or match.group(2))
+        position = match.end()
+    return tokens
+
+
+class ExpressionParser:
+    # recursive descent over | (lowest), & and ! (highest) with parentheses, builds python code over the bitmask m
+
+    def __init__(self, expression, bits):
+        self.expression = expression
+        self.tokens = tokenize(expression)
+        self.position = 0
+        self.bits = bits
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self):
+        token = self.peek()
+        if token is None:
+            raise InvalidFilterExpression('Unexpected end of {!r}.'.format(self.expression))
+        self.position += 1
+        return token
+
+    def parse(self):
+        code = self.parse_or()
+        if self.peek() is not None:
+            raise InvalidFilterExpression('Unexpected {!r} in {!r}.'.format(self.peek(), self.expression))
+        return code
+
+    def parse_or(self):
+        codes = [self.parse_and()]
+        while self.peek() == '|':
+            self.take()
+            codes.append(self.parse_and())
+        return codes[0] if len(codes) == 1 else '({})'.format(' or '.join(codes))
+
+    def parse_and(self):
+        codes = [self.parse_not()]
+        while self.peek() == '&':
+            self.take()
+            codes.append(self.parse_not())
+        return codes[0] if len(codes) == 1 else '({})'.format(' and '.join(codes))
+
+    def parse_not(self):
+        if self.peek() == '!':
+            self.take()
+            return '(not {})'.format(self.parse_not())
+        return self.parse_atom()
+
+    def parse_atom(self):
+        token = self.take()
+        if token == '(':
+            code = self.parse_or()
+            if self.take() != ')':
+                raise InvalidFilterExpression('Missing ) in {!r}.'.format(self.expression))
+            return code
+        if token in ')|&':
+            raise InvalidFilterExpression('Unexpected {!r} in {!r}.'.format(token, self.expression))
+        bit = self.bits.setdefault(token, 1 << len(self.bits))
+        return '(m & {} != 0)'.format(bit)
+
+
+def compile_expression(expression):
+    bits = {}
+    code = ExpressionParser(expression, bits).parse()
+    return CONLLUPFilter(code, bits)
+
+
+def compile_filters(expression):
+    # compiles e.g. 'datasets: (hr500k-train | ud-train) & !ud-test; annotations: NE & DP' into a dict of section
+    # name to CONLLUPFilter, sections that are not given are missing
+    filters = {}
+    for section in expression.split(';'):
+        if not section.strip():
+            continue
+        name, separator, section_expression = section.partition(':')
+        name = name.strip()
+        if not separator or name not in FILTER_SECTIONS:
+            raise InvalidFilterExpression('Expected one of {} followed by : in {!r}.'.format(
+                ', '.join(FILTER_SECTIONS), section.strip()
+            ))
+        if name in filters:
+            raise InvalidFilterExpression('Section {} is given more than once.'.format(name))
+        filters[name] = compile_expression(section_expression)
+    return filters
+
+
+def any_of(names):
+    return compile_expression(' | '.join(sorted(names)))
+
+
+def all_of(names):
+    return compile_expression(' & '.join(sorted(names)))
+
+
+def none_of(names):
+    return compile_expression('!({})'.format(' | '.join(sorted(names))))
+
+
+def combine(*filters):
+    # conjunction of the given filters, None if there are none
+    filters = [f for f in filters if f is not None]
+    if not filters:
+        return None
+    combined = filters[0]
+    for f in filters[1:]:
+        combined = combined & f
+    return combined
+
+
+def create_filters(datasets=[], omit_datasets=[], annotations=[], omit_annotations=[], expression=None):
+    # dataset and annotation filters equivalent to the include/omit sets combined with the filter expression
+    filters = compile_filters(expression) if expression else {}
+    dataset_filter = combine(
+        any_of(datasets) if datasets else None,
+        none_of(omit_datasets) if omit_datasets else None,
+        filters.get('datasets')
+    )
+    annotation_filter = combine(
+        all_of(annotations) if annotations else None,
+        none_of(omit_annotations) if omit_annotations else None,
+        filters.get('annotations')
+    )
+    return dataset_filter, annotation_filter
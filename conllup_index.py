@@ -0,0 +1,249 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+
+from io import StringIO
+
+
+INDEX_VERSION = 1
+INDEX_EXTENSION = '.idx'
+MAX_BLOCK_SIZE = 1 << 24
+
+DOCUMENT_ID_RE = re.compile(r'(?<=(?:# newdoc id = ))(.+)(?=\n)')
+SENTENCE_ID_RE = re.compile(r'(?<=(?:# sent_id = ))(.+)(?=\n)')
+DATASETS_RE = re.compile(r'(?<=(?:# contained_in_datasets = ))(.+)(?=\n)')
+ANNOTATIONS_RE = re.compile(r'(?<=(?:# annotation_levels = ))(.+)(?=\n)')
+
+
+def index_filename(source):
+    return '{}{}'.format(source, INDEX_EXTENSION)
+
+
+def file_hash(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def search(regex, line):
+    match = regex.search(line)
+    return match.group(0) if match else None
+
+
+class CONLLUPIndex:
+    # Byte offsets of all documents and sentences of a .conllup file along with their dataset and annotation status.
+    # Documents are stored as dicts with keys id, offset, end, line, datasets, annotations and sentences, sentences as
+    # dicts with keys id, offset, end, line and datasets. Line numbers are 1-based and point to the # newdoc and
+    # # sent_id lines. The preamble is everything before the first document.
+
+    def __init__(self, source, size, mtime, sha1, preamble_end, documents):
+        self.source = source
+        self.size = size
+        self.mtime = mtime
+        self.sha1 = sha1
+        self.preamble_end = preamble_end
+        self.documents = documents
+        self.document_ids = {d['id']: d for d in documents}
+        self.sentence_ids = {s['id']: s for d in documents for s in d['sentences']}
+
+    @staticmethod
+    def build(source):
+        stat = os.stat(source)
+        sha1 = hashlib.sha1()
+        documents = []
+        document = None
+        sentence = None
+        preamble_end = None
+        offset = 0
+
+        with open(source, 'rb') as f:
+            for line_no, raw_line in enumerate(f, 1):
+                sha1.update(raw_line)
+                line = raw_line.decode('utf-8')
+
+                if line.startswith('# newdoc'):
+                    if preamble_end is None:
+                        preamble_end = offset
+                    if document:
+                        document['end'] = offset
+                    if sentence:
+                        sentence['end'] = offset
+                    sentence = None
+                    document = {'id': search(DOCUMENT_ID_RE, line), 'offset': offset, 'end': None, 'line': line_no,
+                                'datasets': None, 'annotations': None, 'sentences': []}
+                    documents.append(document)
+
+                elif line.startswith('# sent_id'):
+                    if sentence:
+                        sentence['end'] = offset
+                    sentence = {'id': search(SENTENCE_ID_RE, line), 'offset': offset, 'end': None, 'line': line_no,
+                                'datasets': None}
+                    if document:
+                        document['sentences'].append(sentence)
+
+                elif line.startswith('# contained_in_datasets'):
+                    datasets = search(DATASETS_RE, line)
+                    datasets = datasets.split(';') if datasets is not None else None
+                    if sentence:
+                        if sentence['datasets'] is None:
+                            sentence['datasets'] = datasets
+                    elif document and document['datasets'] is None:
+                        document['datasets'] = datasets
+
+                elif line.startswith('# annotation_levels'):
+                    annotations = search(ANNOTATIONS_RE, line)
+                    if document and not sentence and document['annotations'] is None:
+                        document['annotations'] = annotations.split(';') if annotations is not None else None
+
+                offset += len(raw_line)
+
+        if document:
+            document['end'] = offset
+        if sentence:
+            sentence['end'] = offset
+        if preamble_end is None:
+            preamble_end = offset
+
+        return CONLLUPIndex(source, stat.st_size, stat.st_mtime_ns, sha1.hexdigest(), preamble_end, documents)
+
+    @staticmethod
+    def load(source):
+        # returns None if there is no index or it is out of date
+        try:
+            with open(index_filename(source), 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if data.get('version') != INDEX_VERSION:
+            return None
+
+        stat = os.stat(source)
+        if stat.st_size != data['size']:
+            return None
+
+        index = CONLLUPIndex(source, data['size'], data['mtime'], data['sha1'], data['preamble_end'],
+                             data['documents'])
+        if stat.st_mtime_ns != data['mtime']:
+            # same size, but touched, check whether the content changed
+            if file_hash(source) != data['sha1']:
+                return None
+            index.mtime = stat.st_mtime_ns
+            index.save()
+
+        return index
+
+    @staticmethod
+    def get(source, rebuild=False):
+        index = None if rebuild else CONLLUPIndex.load(source)
+        if index is None:
+            index = CONLLUPIndex.build(source)
+            index.save()
+        return index
+
+    def save(self):
+        with open(index_filename(self.source), 'w') as f:
+            json.dump({
+                'version': INDEX_VERSION,
+                'size': self.size,
+                'mtime': self.mtime,
+                'sha1': self.sha1,
+                'preamble_end': self.preamble_end,
+                'documents': self.documents
+            }, f)
+
+    def document(self, document_id):
+        return self.document_ids.get(document_id)
+
+    def sentence(self, sentence_id):
+        return self.sentence_ids.get(sentence_id)
+
+    def sentences(self):
+        for document in self.documents:
+            for sentence in document['sentences']:
+                yield sentence
+
+    def preamble(self):
+        return {'offset': 0, 'end': self.preamble_end, 'line': 1}
+
+    def read_block(self, input_stream, block):
+        return read_block(input_stream, block)
+
+    def iter_batches(self, input_stream, documents):
+        # yields (line number, lines) batches of the preamble and the given documents in file order
+        return iter_block_batches(input_stream, [self.preamble()] + list(documents))
+
+
+def read_block(input_stream, block):
+    raw = getattr(input_stream, 'buffer', input_stream)
+    raw.seek(block['offset'])
+    data = raw.read(block['end'] - block['offset'])
+    if isinstance(data, bytes):
+        data = data.decode(getattr(input_stream, 'encoding', None) or 'utf-8')
+    return data
+
+
+def merge_blocks(blocks):
+    # joins adjacent blocks so that they can be read at once
+    merged = []
+    for block in blocks:
+        if merged and merged[-1]['end'] == block['offset'] and block['end'] - merged[-1]['offset'] <= MAX_BLOCK_SIZE:
+            merged[-1]['end'] = block['end']
+        else:
+            merged.append({'offset': block['offset'], 'end': block['end'], 'line': block['line']})
+    return merged
+
+
+def iter_block_batches(input_stream, blocks):
+    # yields (line number, lines) batches of the given blocks
+    for block in merge_blocks(blocks):
+        yield block['line'], StringIO(read_block(input_stream, block), newline=None).readlines()
+
+
+def main(args):
+    index = CONLLUPIndex.get(args.source, rebuild=args.rebuild)
+
+    if args.command == 'get':
+        block = index.document(args.id) or index.sentence(args.id)
+        if block is None:
+            raise KeyError('No document or sentence with id {}.'.format(args.id))
+        with open(args.source, 'r') as infile:
+            print(index.read_block(infile, block), end='')
+
+    elif args.command == 'sample':
+        population = list(index.sentences()) if args.sentences else index.documents
+        sample = random.Random(args.seed).sample(population, min(args.size, len(population)))
+        with open(args.source, 'r') as infile:
+            for block in sorted(sample, key=lambda b: b['offset']):
+                print(index.read_block(infile, block), end='')
+
+    else:
+        print('{}: {} documents, {} sentences'.format(
+            index_filename(args.source), len(index.documents), len(index.sentence_ids)
+        ))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        prog='CONLLUP corpus index',
+        description='Builds a document/sentence byte offset index next to a .conllup file and uses it to look up '
+                    'or sample documents and sentences.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('command', choices=['build', 'get', 'sample'], help='Command to run.')
+    parser.add_argument('source', help='Path to the source file.')
+    parser.add_argument('id', nargs='?', help='Document or sentence id to look up (get).')
+    parser.add_argument('-k', '--size', type=int, default=10, help='Number of documents or sentences to sample.')
+    parser.add_argument('--sentences', action='store_true', help='Sample sentences instead of documents.')
+    parser.add_argument('--seed', type=int, help='Random seed for sampling.')
+    parser.add_argument('--rebuild', action='store_true', help='Rebuild the index even if it is up to date.')
+    args = parser.parse_args()
+    if args.command == 'get' and not args.id:
+        parser.error('the following arguments are required for get: id')
+    main(args)
@@ -0,0 +1,86 @@
+import mmap
+import os
+
+from io import StringIO
+
+
+BLOCK_SIZE = 1 << 16
+
+
+class CONLLUPMappedReader:
+    # Memory-maps a .conllup file and reads it in blocks of whole lines. Each block is decoded at once and split into
+    # lines in bulk, regions that nobody reads are skipped with bytes.find without being decoded at all.
+
+    def __init__(self, filename, encoding='utf-8', block_size=BLOCK_SIZE):
+        self.filename = filename
+        self.encoding = encoding
+        self.block_size = block_size
+        self.file = open(filename, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+    def block_end(self, start):
+        # end of the last whole line in the block starting at start
+        if start + self.block_size >= self.size:
+            return self.size
+        end = self.map.find(b'\n', start + self.block_size)
+        return self.size if end < 0 else end + 1
+
+    def ranges(self, count):
+        # cuts the file into about count byte ranges of whole lines
+        ranges = []
+        start = 0
+        for i in range(1, count + 1):
+            end = self.size if i == count else self.map.find(b'\n', max(start, self.size * i // count))
+            end = self.size if end < 0 or i == count else end + 1
+            if end > start:
+                ranges.append((start, end))
+            start = end
+        return ranges
+
+    def read_lines(self, start, end):
+        return StringIO(self.map[start:end].decode(self.encoding), newline=None).readlines()
+
+    def count_lines(self, start, end):
+        return self.map[start:end].count(b'\n')
+
+    def find_line(self, start, marks):
+        # offset of the first line at or after start (a line start) beginning with one of the marks
+        found = self.size
+        for mark in marks:
+            mark = mark.encode(self.encoding)
+            if self.map[start:start + len(mark)] == mark:
+                return start
+            position = self.map.find(b'\n' + mark, start, found)
+            if position >= 0:
+                found = position + 1
+        return found
+
+    def batches(self, skip_marks=lambda: None):
+        # yields (line number, lines) batches, after every batch skip_marks is asked whether the following lines can
+        # be skipped up to the first line starting with one of the marks it returns
+        position = 0
+        line_no = 1
+        while position < self.size:
+            end = self.block_end(position)
+            lines = self.read_lines(position, end)
+            yield line_no, lines
+            line_no += len(lines)
+            position = end
+
+            marks = skip_marks()
+            if marks and position < self.size:
+                end = self.find_line(position, marks)
+                line_no += self.count_lines(position, end)
+                position = end
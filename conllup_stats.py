@@ -0,0 +1,164 @@
+import cProfile
+import json
+import pstats
+import sys
+import time
+import tracemalloc
+
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+
+
+class Stats:
+    # Counters and timers of a run of a tool. Timers accumulate seconds spent in named stages, the total time and the
+    # peak memory (traced with tracemalloc) are measured between start and stop. Rates are derived from the tokens
+    # and bytes_written counters.
+
+    def __init__(self, trace_memory=True):
+        self.counters = OrderedDict()
+        self.timers = OrderedDict()
+        self.trace_memory = trace_memory
+        self.started = None
+        self.total = 0
+        self.peak_memory = None
+
+    def start(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        self.started = time.perf_counter()
+
+    def stop(self):
+        self.total = time.perf_counter() - self.started
+        if self.trace_memory:
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def update(self, counts, prefix=''):
+        for name, value in counts.items():
+            self.count('{}{}'.format(prefix, name), value)
+
+    def add_time(self, name, seconds):
+        self.timers[name] = self.timers.get(name, 0) + seconds
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def batches(self, batches):
+        # times reading of (line number, lines) batches and counts their lines
+        batches = iter(batches)
+        while True:
+            start = time.perf_counter()
+            batch = next(batches, None)
+            self.add_time('read', time.perf_counter() - start)
+            if batch is None:
+                return
+            self.count('lines_read', len(batch[1]))
+            yield batch
+
+    def lines(self, lines):
+        # counts (line number, line) pairs
+        for line in lines:
+            self.counters['lines_read'] = self.counters.get('lines_read', 0) + 1
+            yield line
+
+    def writer(self, stream):
+        # output stream or a mapping of names to output streams, with timed and counted writes
+        if isinstance(stream, dict):
+            return OrderedDict([(name, CountingWriter(s, self)) for name, s in stream.items()])
+        return CountingWriter(stream, self)
+
+    def report(self):
+        timers = OrderedDict(self.timers)
+        # time not spent in any of the timed stages, i.e. parsing and converting
+        timers['other'] = max(0, self.total - sum(self.timers.values()))
+        report = OrderedDict([('total_seconds', self.total), ('peak_memory_bytes', self.peak_memory),
+                              ('counters', OrderedDict(self.counters)), ('timers', timers)])
+        if self.total:
+            if 'tokens' in self.counters:
+                report['tokens_per_second'] = self.counters['tokens'] / self.total
+            if 'lines_read' in self.counters:
+                report['lines_per_second'] = self.counters['lines_read'] / self.total
+            if 'bytes_written' in self.counters:
+                report['written_megabytes_per_second'] = self.counters['bytes_written'] / self.total / (1 << 20)
+        return report
+
+    def summary(self):
+        report = self.report()
+        lines = ['Total time: {:.3f} s'.format(report['total_seconds'])]
+        if report['peak_memory_bytes'] is not None:
+            lines.append('Peak memory: {:.1f} MB'.format(report['peak_memory_bytes'] / (1 << 20)))
+        for name, seconds in report['timers'].items():
+            lines.append('  {:<40} {:>10.3f} s'.format(name, seconds))
+        for name, value in report['counters'].items():
+            lines.append('  {:<40} {:>12}'.format(name, value))
+        for name in ['tokens_per_second', 'lines_per_second', 'written_megabytes_per_second']:
+            if name in report:
+                lines.append('  {:<40} {:>12.1f}'.format(name, report[name]))
+        return '\n'.join(lines)
+
+
+class CountingWriter:
+    # text output stream wrapper, which adds the time spent writing and the number of bytes written to the stats
+    def __init__(self, stream, stats, encoding='utf-8'):
+        self.stream = stream
+        self.stats = stats
+        self.encoding = encoding
+
+    def write(self, data):
+        start = time.perf_counter()
+        written = self.stream.write(data)
+        self.stats.add_time('write', time.perf_counter() - start)
+        self.stats.count('bytes_written', len(data.encode(self.encoding)))
+        return written
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def stage(stats, name):
+    # timer of a stage of the run, or nothing when there are no stats
+    return nullcontext() if stats is None else stats.timer(name)
+
+
+def add_stats_arguments(parser):
+    parser.add_argument('--stats', action='store_true',
+                        help='Print counters, stage timings, throughput and peak memory to stderr.')
+    parser.add_argument('--stats-json', dest='stats_json', help='Write the statistics to this JSON file.')
+    parser.add_argument('--profile', dest='profile',
+                        help='Run under cProfile and dump the profile to this file (see python -m pstats).')
+
+
+def run_with_stats(main, args):
+    # runs main(args, stats), where stats is None unless --stats or --stats-json is given, and returns its result
+    stats = Stats() if args.stats or args.stats_json else None
+    profiler = cProfile.Profile() if args.profile else None
+
+    if stats is not None:
+        stats.start()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        result = main(args, stats)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if stats is not None:
+            stats.stop()
+
+    if profiler is not None and args.stats:
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(20)
+    if stats is not None and args.stats:
+        print(stats.summary(), file=sys.stderr)
+    if stats is not None and args.stats_json:
+        with open(args.stats_json, 'w') as f:
+            json.dump(stats.report(), f, indent=2)
+    return result
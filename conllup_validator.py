@@ -0,0 +1,346 @@
+import argparse
+import re
+import sys
+
+from collections import Counter, namedtuple
+from compressed_io import open_input
+from conllup_stats import add_stats_arguments, run_with_stats, stage
+
+
+COLUMNS = ['ID', 'FORM', 'LEMMA', 'UPOS', 'XPOS', 'FEATS', 'HEAD', 'DEPREL', 'DEPS', 'MISC', 'RELDI:NE', 'RELDI:DP',
+           'RELDI:SRL', 'PARSEME:MWE', 'RELDI:MISC']
+GLOBAL_COLUMNS = '# global.columns = {}'.format(' '.join(COLUMNS))
+NULL_VALUES = ('_', '*')
+# annotation level of each annotation column and the values that do not count as annotated
+ANNOTATION_COLUMNS = [(10, 'NE', NULL_VALUES + ('O',)), (11, 'DP', NULL_VALUES), (12, 'SRL', NULL_VALUES),
+                      (13, 'PARSEME', NULL_VALUES)]
+
+ID_RE = re.compile(r'^(?:[1-9][0-9]*|[1-9][0-9]*-[1-9][0-9]*|[0-9]+\.[1-9][0-9]*)$')
+NE_RE = re.compile(r'^(?:[*_O]|([BI])-(\S+))$')
+MWE_RE = re.compile(r'^([1-9][0-9]*)(?::(\S+))?$')
+# RELDI:DP is the head and the relation of the token, RELDI:SRL a |-separated list of roles, each optionally with the
+# id of its predicate
+DP_RE = re.compile(r'^(0|[1-9][0-9]*):([^\s|:][^\s|]*)$')
+SRL_ITEM_RE = re.compile(r'^(?:([1-9][0-9]*):)?([^\s|:][^\s|]*)$')
+MISC_ITEM_RE = re.compile(r'^[^=|\s]+=[^=|]+$')
+NAME_LIST_RE = re.compile(r'^[^;\s*]+\*?(?:;[^;\s*]+\*?)*$')
+SPACE_RE = re.compile(r'^\s|\s$')
+# signs of empty columns or spaces around a column in a token line, the columns are checked one by one only then
+LINE_SPACE_MARKS = ('\t\t', ' \t', '\t ')
+
+
+class ValidationError(namedtuple('ValidationError', ['line', 'sentence', 'kind', 'code', 'message'])):
+    def __str__(self):
+        sentence = ' Sent {}'.format(self.sentence) if self.sentence else ''
+        return '[Line {}{}]: [{} {}] {}'.format(self.line, sentence, self.kind, self.code, self.message)
+
+
+class ValidationLimitReached(Exception):
+    pass
+
+
+class CONLLUPValidator:
+    # Checks all 15 columns of a .conllup file and its ReLDI metadata in one pass over the lines: the
+    # # global.columns header, token ids, MISC and RELDI:MISC key=value syntax, BIO sequences of RELDI:NE, PARSEME:MWE
+    # numbering, head:relation values of RELDI:DP, roles of RELDI:SRL, annotations in documents without the annotation level, and
+    # document and sentence metadata. Raises ValidationLimitReached after max_errors errors (0 for no limit).
+
+    def __init__(self, max_errors=0):
+        self.max_errors = max_errors
+        self.errors = []
+        self.line_no = 0
+        self.sentence_id = None
+        self.sentence_ids = set()
+        self.document_ids = set()
+        self.document_datasets = None
+        self.document_levels = None
+        self.document_sentences = 0
+        self.partial = False
+        self.tokens = []
+        self.comments = []
+        self.counts = Counter()
+
+    def error(self, kind, code, message, line=None):
+        self.errors.append(ValidationError(line or self.line_no, self.sentence_id, kind, code, message))
+        if self.max_errors and len(self.errors) >= self.max_errors:
+            raise ValidationLimitReached()
+
+    def validate(self, lines):
+        try:
+            for self.line_no, line in enumerate(lines, 1):
+                self.feed(line)
+            self.line_no += 1
+            if self.tokens:
+                self.error('Format', 'missing-empty-line', 'Missing empty line after the last sentence.')
+                self.end_sentence()
+        except ValidationLimitReached:
+            pass
+        return self.errors
+
+    def feed(self, line):
+        if line.endswith('\n'):
+            line = line[:-1]
+        else:
+            self.error('Format', 'missing-final-newline', 'Missing newline at the end of the file.')
+
+        if self.line_no == 1:
+            if line != GLOBAL_COLUMNS:
+                self.error('Metadata', 'global-columns', 'The first line must be {!r}.'.format(GLOBAL_COLUMNS))
+            if line.startswith('# global.columns'):
+                return
+
+        if line.startswith('#'):
+            if self.tokens:
+                self.error('Format', 'missing-empty-line', 'Comment line right after a token line.')
+                self.end_sentence()
+            self.comments.append(line)
+            self.feed_comment(line)
+        elif not line:
+            if self.tokens:
+                self.end_sentence()
+            else:
+                self.error('Format', 'empty-sentence', 'Empty line not closing a sentence.')
+        else:
+            self.tokens.append((self.line_no, line))
+
+    def feed_comment(self, line):
+        if line.startswith('# global.columns'):
+            self.error('Metadata', 'global-columns', 'The # global.columns line must be the first line.')
+
+        elif line.startswith('# newdoc'):
+            self.counts['documents'] += 1
+            self.sentence_id = None
+            document_id = line.partition(' = ')[2]
+            if not document_id:
+                self.error('Metadata', 'newdoc-id', 'Missing document id in {!r}.'.format(line))
+            elif document_id in self.document_ids:
+                self.error('Metadata', 'non-unique-newdoc-id', 'Non-unique newdoc id {!r}.'.format(document_id))
+            self.document_ids.add(document_id)
+            self.document_datasets = []
+            self.document_levels = None
+            self.document_sentences = 0
+            self.partial = False
+
+        elif line.startswith('# sent_id'):
+            if any([comment.startswith('# sent_id') for comment in self.comments[:-1]]):
+                self.error('Metadata', 'sentence-without-tokens', 'Sentence {} has no tokens.'.format(
+                    self.sentence_id))
+            self.sentence_id = line.partition(' = ')[2] or None
+            if self.sentence_id is None:
+                self.error('Metadata', 'sent-id', 'Missing sentence id in {!r}.'.format(line))
+            elif self.sentence_id in self.sentence_ids:
+                self.error('Metadata', 'non-unique-sent-id', "Non-unique sent_id attribute '{}'.".format(
+                    self.sentence_id))
+            self.sentence_ids.add(self.sentence_id)
+
+        elif line.startswith('# contained_in_datasets'):
+            value = line.partition(' = ')[2]
+            if not NAME_LIST_RE.match(value):
+                self.error('Metadata', 'contained-in-datasets', 'Invalid dataset list {!r}.'.format(value))
+                return
+            datasets = value.split(';')
+            if self.document_datasets == [] and not self.sentence_id and not self.document_sentences:
+                self.document_datasets = datasets
+                self.partial = any([d.endswith('*') for d in datasets])
+            elif self.sentence_id and self.partial:
+                # sentence of a partially contained document
+                partial = [d.rstrip('*') for d in self.document_datasets if d.endswith('*')]
+                for dataset in datasets:
+                    if dataset.endswith('*') or dataset not in partial:
+                        self.error('Metadata', 'sentence-datasets', 'Dataset {!r} of the sentence is not a partially '
+                                                                    'contained dataset of the document.'.format(dataset))
+            else:
+                self.error('Metadata', 'contained-in-datasets', 'Unexpected # contained_in_datasets line, it is '
+                                                                'only allowed after # newdoc and in sentences of '
+                                                                'partially contained documents.')
+
+        elif line.startswith('# annotation_levels'):
+            value = line.partition(' = ')[2]
+            if self.sentence_id or self.document_sentences or self.document_levels is not None:
+                self.error('Metadata', 'annotation-levels', 'Unexpected # annotation_levels line, it is only '
+                                                            'allowed once after # newdoc.')
+            elif value != '_' and not NAME_LIST_RE.match(value):
+                self.error('Metadata', 'annotation-levels', 'Invalid annotation level list {!r}.'.format(value))
+            else:
+                self.document_levels = set() if value == '_' else set(value.split(';'))
+
+        elif not line.startswith('# '):
+            self.error('Format', 'comment', "Comment line must start with '# '.")
+
+    def end_sentence(self):
+        # checks the tokens of the sentence, the sentence id and comments are cleared for the next sentence afterwards
+        try:
+            self.check_sentence(self.tokens)
+        finally:
+            self.tokens = []
+            self.comments = []
+            self.sentence_id = None
+            self.document_sentences += 1
+
+    def check_sentence(self, tokens):
+        self.counts['sentences'] += 1
+        self.counts['tokens'] += len(tokens)
+        if self.sentence_id is None and self.document_datasets is not None:
+            self.error('Metadata', 'missing-sent-id', 'Missing # sent_id line of the sentence.', tokens[0][0])
+
+        error = self.error
+        word_id = 0
+        ne_type = None
+        mwe_categories = {}
+        heads = []
+        levels = self.document_levels
+        for line_no, line in tokens:
+            columns = line.split('\t')
+            if len(columns) != len(COLUMNS):
+                error('Format', 'number-of-columns', 'Expected {} columns, got {}.'.format(len(COLUMNS), len(columns)),
+                      line_no)
+                continue
+
+            suspicious = line[:1].isspace() or line[-1:].isspace() or any([m in line for m in LINE_SPACE_MARKS])
+            for name, value in zip(COLUMNS, columns) if suspicious else ():
+                if not value:
+                    error('Format', 'empty-column', 'Empty {} column.'.format(name), line_no)
+                elif SPACE_RE.search(value):
+                    error('Format', 'leading-trailing-whitespace', 'Leading or trailing whitespace in the {} '
+                                                                   'column.'.format(name), line_no)
+
+            index = columns[0]
+            if index.isdigit() and index[0] != '0':
+                word_id += 1
+                if int(index) != word_id:
+                    error('Format', 'word-id-sequence', 'Expected ID {}, got {}.'.format(word_id, index), line_no)
+            elif not ID_RE.match(index):
+                error('Format', 'invalid-word-id', 'Invalid ID {!r}.'.format(index), line_no)
+            elif '-' in index:
+                start, end = index.split('-')
+                if int(start) != word_id + 1 or int(end) <= int(start):
+                    error('Format', 'invalid-word-interval', 'Invalid multiword token range {}.'.format(index),
+                          line_no)
+                # multiword tokens are not annotated
+                continue
+
+            for misc_index, name in ((9, 'MISC'), (14, 'RELDI:MISC')):
+                misc = columns[misc_index]
+                if misc != '_':
+                    for item in misc.split('|'):
+                        if not MISC_ITEM_RE.match(item):
+                            error('MISC', 'misc-attribute', 'Invalid {} attribute {!r}, expected Key=Value.'.format(
+                                name, item), line_no)
+
+            ne = columns[10]
+            match = None if ne == 'O' else NE_RE.match(ne)
+            if ne == 'O':
+                ne_type = None
+            elif not match:
+                error('NE', 'invalid-ne', 'Invalid RELDI:NE value {!r}.'.format(ne), line_no)
+                ne_type = None
+            elif match.group(1) == 'I' and ne_type != match.group(2):
+                error('NE', 'ne-bio', 'RELDI:NE {} does not continue an entity of the same type.'.format(ne), line_no)
+                ne_type = match.group(2)
+            else:
+                ne_type = match.group(2)
+
+            dp = columns[11]
+            if dp not in NULL_VALUES:
+                match = DP_RE.match(dp)
+                if not match:
+                    error('DP', 'invalid-dp', 'Invalid RELDI:DP value {!r}, expected HEAD:RELATION.'.format(dp),
+                          line_no)
+                else:
+                    heads.append((line_no, 'DP', int(match.group(1))))
+
+            srl = columns[12]
+            if srl not in NULL_VALUES:
+                for item in srl.split('|'):
+                    match = SRL_ITEM_RE.match(item)
+                    if not match:
+                        error('SRL', 'invalid-srl', 'Invalid RELDI:SRL role {!r}, expected ROLE or '
+                                                    'PREDICATE:ROLE.'.format(item), line_no)
+                    elif match.group(1):
+                        heads.append((line_no, 'SRL', int(match.group(1))))
+
+            mwe = columns[13]
+            if mwe not in NULL_VALUES:
+                seen = set()
+                for item in mwe.split(';'):
+                    match = MWE_RE.match(item)
+                    if not match:
+                        error('PARSEME', 'invalid-mwe', 'Invalid PARSEME:MWE code {!r}.'.format(item), line_no)
+                        continue
+                    number, category = int(match.group(1)), match.group(2)
+                    if number in seen:
+                        error('PARSEME', 'repeated-mwe', 'MWE {} repeated in the token.'.format(number), line_no)
+                    seen.add(number)
+                    if number not in mwe_categories:
+                        if number != len(mwe_categories) + 1:
+                            error('PARSEME', 'mwe-numbering', 'MWE {} found where {} was expected, MWEs are numbered '
+                                                              'from 1 in the order of their first tokens.'.format(
+                                                                  number, len(mwe_categories) + 1), line_no)
+                        if category is None:
+                            error('PARSEME', 'mwe-category', 'Missing category of MWE {} on its first '
+                                                             'token.'.format(number), line_no)
+                        mwe_categories[number] = category
+                    elif category is not None:
+                        error('PARSEME', 'mwe-category', 'Category of MWE {} repeated after its first '
+                                                         'token.'.format(number), line_no)
+
+            if levels is not None:
+                for column, level, null_values in ANNOTATION_COLUMNS:
+                    if level not in levels and columns[column] not in null_values:
+                        error('Metadata', 'annotation-level', '{} value {!r} in a document without the {} annotation '
+                                                              'level.'.format(COLUMNS[column], columns[column], level),
+                              line_no)
+
+        for line_no, kind, head in heads:
+            if head > word_id:
+                error(kind, 'invalid-head', 'RELDI:{} head {} is not a word of the sentence.'.format(kind, head),
+                      line_no)
+
+
+def validate(lines, max_errors=0):
+    # errors of the .conllup lines and the counts of lines, documents, sentences and tokens read
+    validator = CONLLUPValidator(max_errors)
+    errors = validator.validate(lines)
+    validator.counts['lines_read'] = validator.line_no
+    return errors, validator.counts
+
+
+def print_report(errors, output_stream=sys.stderr):
+    # the errors and a summary in the format of the UD validator
+    for error in errors:
+        print(error, file=output_stream)
+    kinds = Counter([error.kind for error in errors])
+    for kind, count in sorted(kinds.items()):
+        print('{} errors: {}'.format(kind, count), file=output_stream)
+    if errors:
+        print('*** FAILED *** with {} errors'.format(len(errors)), file=output_stream)
+    else:
+        print('*** PASSED ***', file=output_stream)
+
+
+def main(args, stats=None):
+    with stage(stats, 'validate'), open_input(args.source) as infile:
+        errors, counts = validate(infile, args.max_err)
+    if not args.quiet:
+        print_report(errors)
+    if stats is not None:
+        stats.update(counts)
+        stats.count('errors', len(errors))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        prog='CONLLUP ReLDI validator',
+        description='Validates all columns and the ReLDI metadata of a .conllup corpus in a single pass.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('source', help='Path to the source file (compressed files are decompressed, - reads from '
+                                       'stdin).')
+    parser.add_argument('--max-err', type=int, default=20, help='Stop after this many errors, 0 for all.')
+    parser.add_argument('--quiet', action='store_true', help='Do not print any error messages. Exit with 0 on pass, '
+                                                             'non-zero on fail.')
+    add_stats_arguments(parser)
+    args = parser.parse_args()
+    sys.exit(run_with_stats(main, args))
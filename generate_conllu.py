@@ -1,16 +1,30 @@
 import argparse
+import hashlib
+import json
 import os
 import re
 
-from collections import namedtuple, OrderedDict
+from collections import Counter, namedtuple, OrderedDict
+from compressed_io import (STDIO, compression_from_extension, is_plain_file, open_input, open_output,
+                           strip_compression_extension)
+from concurrent.futures import ProcessPoolExecutor
+from conllup_filter import compile_filters, create_filters, InvalidFilterExpression
+from conllup_index import CONLLUPIndex, iter_block_batches
+from conllup_reader import CONLLUPMappedReader
+from conllup_stats import add_stats_arguments, run_with_stats, stage
+from contextlib import ExitStack
 from enum import Enum
 from io import StringIO
+from itertools import repeat
 
 
 DATASETS_RE = re.compile(r'(?<=(?:# contained_in_datasets = ))(.+)(?=\n)')
 ANNOTATIONS_RE = re.compile(r'(?<=(?:# annotation_levels = ))(.+)(?=\n)')
 
 CORPUS_NULL_VALUES = ['_', '*']
+SHARDS_PER_JOB = 4
+MANIFEST_VERSION = 1
+MANIFEST_EXTENSION = '.manifest'
 ReadingMode = Enum('ReadingMode', ['DOCUMENT', 'SENTENCE'])
 
 
@@ -68,212 +82,615 @@ class CONLLUToken(namedtuple('CONLLUToken', ['index', 'form', 'lemma', 'upos', '
         return CONLLUToken(*token[:10])
 
 
-def generate(input_stream, output_stream, datasets=[], omit_datasets=[], annotations=[], omit_annotations=[],
-             misc=[], keep_status=False):
-
-    line_no = 0
-
-    def consume_till_end(*end_marks, flush=False):
-        nonlocal line_no
-
-        while True:
-            line = input_stream.readline()
-            line_no += 1
-
-            if not line or any([line.startswith(end_mark) for end_mark in end_marks]):
-                break
-
-            if flush:
-                continue
-
-            if line.startswith('# contained_in_datasets') or line.startswith('# annotation_levels'):
-                if keep_status:
-                    output_stream.write(line)
-
-            elif line.startswith('# ') or not line.strip():
-                output_stream.write(line)
+DOCUMENT_END_MARKS = ('# newdoc',)
+SENTENCE_END_MARKS = ('# sent_id', '# newdoc')
+STATUS_MARKS = ('# contained_in_datasets', '# annotation_levels')
 
-            else:
-                try:
-                    output_stream.write(
-                        CONLLUToken.create_from_conllup_token(
-                            CONLLUPToken.create_from_conllup_line(line.strip()),
-                            misc
-                        ).to_conllu_line()
-                    )
-                except InvalidCONLLUPToken as e:
-                    raise TypeError('Line number {}: {}'.format(line_no, str(e)))
 
-        return line
+class CONLLUTokenConverter:
+    def __init__(self, misc=[]):
+        self.misc = misc
+        self.line = None
+        self.converted = None
+        # without transfers to MISC the first 10 columns are output as they are, so there is no need to build tokens
+        self.convert = self.materialize if misc else self.project
 
-    read_buffer = StringIO()
+    def __call__(self, line):
+        # token lines are shared by all outputs, convert each of them only once
+        if line is not self.line:
+            self.converted = self.convert(line)
+            self.line = line
+        return self.converted
 
-    reading_mode = ReadingMode.DOCUMENT
+    def materialize(self, line):
+        return CONLLUToken.create_from_conllup_token(
+            CONLLUPToken.create_from_conllup_line(line.strip()),
+            self.misc
+        ).to_conllu_line()
 
-    line = input_stream.readline()
-    line_no += 1
+    @staticmethod
+    def project(line):
+        line = line.strip()
+        columns = line.count('\t') + 1
+        if columns != 15:
+            raise InvalidCONLLUPToken("Invalid token. Expected 15 columns, got {}.".format(str(columns)))
+        return line.rsplit('\t', 5)[0] + '\n'
+
+
+class CONLLUOutput:
+    def __init__(self, output_stream, convert, dataset_filter=None, annotation_filter=None, keep_status=False):
+        self.output_stream = output_stream
+        self.convert = convert
+        self.dataset_filter = dataset_filter
+        self.annotation_filter = annotation_filter
+        self.keep_status = keep_status
+
+        self.reading_mode = ReadingMode.DOCUMENT
+        self.read_buffer = []
+        self.end_marks = None
+        self.flush = False
+        # documents read, documents and sentences buffered and dropped (by filter reason) and tokens converted
+        self.counts = Counter()
+
+    def consume_till_end(self, *end_marks, flush=False):
+        self.end_marks = end_marks
+        self.flush = flush
+
+    def write_buffer(self):
+        self.output_stream.write(''.join(self.read_buffer))
+        self.read_buffer = []
+
+    def write_line(self, line):
+        if line.startswith(STATUS_MARKS):
+            if self.keep_status:
+                self.output_stream.write(line)
 
-    while True:
+        elif line.startswith('# ') or not line.strip():
+            self.output_stream.write(line)
 
-        if not line:
-            break
+        else:
+            self.counts['tokens'] += 1
+            self.output_stream.write(self.convert(line))
+
+    def skips_document(self, doc_datasets, doc_annotations):
+        # whether a document with the given status would be flushed as a whole, unknown status is never skipped
+        if self.dataset_filter and doc_datasets is not None and not self.dataset_filter(doc_datasets):
+            return True
+
+        if self.annotation_filter and doc_annotations is not None and not self.annotation_filter(doc_annotations):
+            return True
+
+        return False
+
+    def feed_lines(self, lines):
+        # same as feeding the lines one by one, but runs of lines that are written or flushed till the end mark are
+        # handled in a tight loop and written at once, on error the position of the invalid line is kept
+        position = 0
+        count = len(lines)
+        try:
+            while position < count:
+                end_marks = self.end_marks
+                if end_marks and self.flush:
+                    while position < count and not lines[position].startswith(end_marks):
+                        position += 1
+
+                elif end_marks:
+                    # same as write_line, with the checks ordered so that token lines take the fewest of them
+                    keep_status = self.keep_status
+                    convert = self.convert.convert
+                    out = []
+                    tokens = 0
+                    while position < count:
+                        line = lines[position]
+                        if line[:1] == '#':
+                            if line.startswith(end_marks):
+                                break
+                            if line.startswith(STATUS_MARKS):
+                                if keep_status:
+                                    out.append(line)
+                            elif line.startswith('# '):
+                                out.append(line)
+                            else:
+                                out.append(convert(line))
+                                tokens += 1
+                        elif line.strip():
+                            out.append(convert(line))
+                            tokens += 1
+                        else:
+                            out.append(line)
+                        position += 1
+                    self.counts['tokens'] += tokens
+                    self.output_stream.write(''.join(out))
+
+                if position < count:
+                    self.feed(lines[position])
+                    position += 1
+        except InvalidCONLLUPToken:
+            self.position = position
+            raise
+
+    def feed(self, line):
+        if self.end_marks:
+            if not line.startswith(self.end_marks):
+                if not self.flush:
+                    self.write_line(line)
+                return
+            self.end_marks = None
 
         if line.startswith('# global.columns'):
-            line = input_stream.readline()
-            line_no += 1
-            continue
+            return
 
         if line.startswith('# newdoc'):
-            reading_mode = ReadingMode.DOCUMENT
-            read_buffer = StringIO()
-            if any([datasets, omit_datasets, annotations, omit_annotations]):
+            self.reading_mode = ReadingMode.DOCUMENT
+            self.read_buffer = []
+            self.counts['documents'] += 1
+            if self.dataset_filter or self.annotation_filter:
                 # there are limitations, buffer and wait
-                read_buffer.write(line)
+                self.counts['documents_buffered'] += 1
+                self.read_buffer.append(line)
             else:
                 # no limitations, write till the end
-                output_stream.write(line)
-                line = consume_till_end('# newdoc')
-                continue
+                self.output_stream.write(line)
+                self.consume_till_end(*DOCUMENT_END_MARKS)
 
         elif line.startswith('# sent_id'):
-            read_buffer = StringIO()
-            if reading_mode == ReadingMode.SENTENCE and any([datasets, omit_datasets]):
+            self.read_buffer = []
+            if self.reading_mode == ReadingMode.SENTENCE and self.dataset_filter:
                 # there are limitations, buffer and wait
-                read_buffer.write(line)
+                self.counts['sentences_buffered'] += 1
+                self.read_buffer.append(line)
             else:
                 # no limitations, write till the end
-                line = consume_till_end('# sent_id', '# newdoc')
-                continue
+                self.consume_till_end(*SENTENCE_END_MARKS)
 
         elif line.startswith('# contained_in_datasets'):
-            if reading_mode == ReadingMode.DOCUMENT:
-                if datasets or omit_datasets:
+            if self.reading_mode == ReadingMode.DOCUMENT:
+                if self.dataset_filter:
                     # there are dataset-related limitations
                     doc_datasets = DATASETS_RE.search(line).group(0).split(';')
-                    if omit_datasets and set([d.strip('*') for d in doc_datasets]).intersection(omit_datasets):
-                        # document is part of the omited dataset(s), reset buffer and flush
-                        read_buffer = StringIO()
-                        line = consume_till_end('# newdoc', flush=True)
-                        continue
-                    if datasets and not set([d.strip('*') for d in doc_datasets]).intersection(datasets):
-                        # document is not part of the required dataset(s), reset buffer and flush
-                        read_buffer = StringIO()
-                        line = consume_till_end('# newdoc', flush=True)
-                        continue
-
-                    if datasets and any([d.endswith('*') for d in doc_datasets]):
-                        # document is partially in different datasets, switch to sentence mode
-                        reading_mode = ReadingMode.SENTENCE
-
-                    if annotations or omit_annotations:
+                    if not self.dataset_filter(doc_datasets):
+                        # document is part of the omited dataset(s) or not part of the required dataset(s), reset
+                        # buffer and flush
+                        self.counts['documents_dropped_datasets'] += 1
+                        self.read_buffer = []
+                        self.consume_till_end(*DOCUMENT_END_MARKS, flush=True)
+                        return
+
+                    if not self.dataset_filter.accepts_empty and any([d.endswith('*') for d in doc_datasets]):
+                        # document is partially in different datasets and some are required, switch to sentence mode
+                        self.reading_mode = ReadingMode.SENTENCE
+
+                    if self.annotation_filter:
                         # there are annotations-related limitations, buffer and wait
-                        if keep_status:
-                            read_buffer.write(line)
+                        if self.keep_status:
+                            self.read_buffer.append(line)
                     else:
                         # there are no annotations-related limitations, output buffered content and reset buffer
-                        output_stream.write(read_buffer.getvalue())
-                        read_buffer = StringIO()
-                        if keep_status:
-                            output_stream.write(line)
+                        self.write_buffer()
+                        if self.keep_status:
+                            self.output_stream.write(line)
 
-                        if reading_mode == ReadingMode.DOCUMENT:
+                        if self.reading_mode == ReadingMode.DOCUMENT:
                             # no limitations and in document mode, write till the end
-                            line = consume_till_end('# newdoc')
-                            continue
+                            self.consume_till_end(*DOCUMENT_END_MARKS)
 
-                elif annotations or omit_annotations:
+                elif self.annotation_filter:
                     # there are annotations-related limitations, buffer and wait
-                    if keep_status:
-                        read_buffer.write(line)
+                    if self.keep_status:
+                        self.read_buffer.append(line)
                 else:
                     # there are no limitations, output buffered content and reset buffer
-                    output_stream.write(read_buffer.getvalue())
-                    read_buffer = StringIO()
-                    if keep_status:
-                        output_stream.write(line)
+                    self.write_buffer()
+                    if self.keep_status:
+                        self.output_stream.write(line)
 
-                    if reading_mode == ReadingMode.DOCUMENT:
+                    if self.reading_mode == ReadingMode.DOCUMENT:
                         # no limitations and in document mode, write till the end
-                        line = consume_till_end('# newdoc')
-                        continue
+                        self.consume_till_end(*DOCUMENT_END_MARKS)
 
-            elif reading_mode == ReadingMode.SENTENCE:
-                if datasets or omit_datasets:
+            elif self.reading_mode == ReadingMode.SENTENCE:
+                if self.dataset_filter:
                     # there are dataset-related limitations
                     doc_datasets = DATASETS_RE.search(line).group(0).split(';')
-                    if omit_datasets and set(doc_datasets).intersection(omit_datasets):
-                        # sentence is part of the omited dataset(s), reset buffer and flush
-                        line = consume_till_end('# sent_id', '# newdoc', flush=True)
-                        continue
-                    if datasets and not set(doc_datasets).intersection(datasets):
-                        # sentence is not part of the required dataset(s), reset buffer and flush
-                        line = consume_till_end('# sent_id', '# newdoc', flush=True)
-                        continue
+                    if not self.dataset_filter(doc_datasets):
+                        # sentence is part of the omited dataset(s) or not part of the required dataset(s), flush
+                        self.counts['sentences_dropped_datasets'] += 1
+                        self.consume_till_end(*SENTENCE_END_MARKS, flush=True)
+                        return
 
                 # pass all limitations, output buffered content and reset buffer
-                output_stream.write(read_buffer.getvalue())
-                read_buffer = StringIO()
-                if keep_status:
-                    output_stream.write(line)
+                self.write_buffer()
+                if self.keep_status:
+                    self.output_stream.write(line)
 
                 # write till the end
-                line = consume_till_end('# sent_id', '# newdoc')
-                continue
+                self.consume_till_end(*SENTENCE_END_MARKS)
 
         elif line.startswith('# annotation_levels'):
-            if annotations or omit_annotations:
+            if self.annotation_filter:
                 # there are annotations-related limitations
                 doc_annotations = ANNOTATIONS_RE.search(line).group(0).split(';')
-                if omit_annotations and any([a in doc_annotations for a in omit_annotations]):
-                    # document contains omited annotation(s), reset buffer and flush
-                    read_buffer = StringIO()
-                    line = consume_till_end('# newdoc', flush=True)
-                    continue
-                if annotations and not all([a in doc_annotations for a in annotations]):
-                    # document has no required annotation(s), reset buffer and flush
-                    read_buffer = StringIO()
-                    line = consume_till_end('# newdoc', flush=True)
-                    continue
+                if not self.annotation_filter(doc_annotations):
+                    # document contains omited annotation(s) or has no required annotation(s), reset buffer and flush
+                    self.counts['documents_dropped_annotations'] += 1
+                    self.read_buffer = []
+                    self.consume_till_end(*DOCUMENT_END_MARKS, flush=True)
+                    return
 
             # pass all limitations, output buffered content and reset buffer
-            output_stream.write(read_buffer.getvalue())
-            read_buffer = StringIO()
-            if keep_status:
-                output_stream.write(line)
+            self.write_buffer()
+            if self.keep_status:
+                self.output_stream.write(line)
 
-            if reading_mode == ReadingMode.DOCUMENT:
+            if self.reading_mode == ReadingMode.DOCUMENT:
                 # in document mode, write till the end
-                line = consume_till_end('# newdoc')
-                continue
+                self.consume_till_end(*DOCUMENT_END_MARKS)
 
         elif line.startswith('# ') or not line.strip():
-            output_stream.write(line)
+            self.output_stream.write(line)
 
         else:
             # shouldn't end up here
-            try:
-                output_stream.write(
-                    CONLLUToken.create_from_conllup_token(
-                        CONLLUPToken.create_from_conllup_line(line.strip()),
-                        misc
-                    ).to_conllu_line()
-                )
-            except InvalidCONLLUPToken as e:
-                raise TypeError('Line number {}: {}'.format(line_no, str(e)))
-
-        line = input_stream.readline()
-        line_no += 1
-
-
-def main(args):
-    output_file = args.output_file or '{}.conllu'.format(os.path.splitext(args.source)[0])
+            self.counts['tokens'] += 1
+            self.output_stream.write(self.convert(line))
+
+
+def create_outputs(output_stream, misc=[], datasets=[], omit_datasets=[], annotations=[], omit_annotations=[],
+                   keep_status=False, filter_expression=None):
+    convert = CONLLUTokenConverter(misc)
+
+    if isinstance(output_stream, dict):
+        if datasets:
+            raise ValueError('Datasets filter cannot be used when routing output by dataset.')
+        outputs = []
+        for dataset, stream in output_stream.items():
+            dataset_filter, annotation_filter = create_filters({dataset}, omit_datasets, annotations, omit_annotations,
+                                                               filter_expression)
+            outputs.append(CONLLUOutput(stream, convert, dataset_filter, annotation_filter, keep_status))
+        return outputs
+
+    dataset_filter, annotation_filter = create_filters(datasets, omit_datasets, annotations, omit_annotations,
+                                                       filter_expression)
+    return [CONLLUOutput(output_stream, convert, dataset_filter, annotation_filter, keep_status)]
+
+
+def selected_documents(index, outputs):
+    return [d for d in index.documents
+            if not all([output.skips_document(d['datasets'], d['annotations']) for output in outputs])]
+
+
+def skip_marks(outputs):
+    # marks of the lines up to which all outputs flush the input, None if any of them is reading it
+    marks = set()
+    for output in outputs:
+        if not (output.end_marks and output.flush):
+            return None
+        marks.update(output.end_marks)
+    return marks
+
+
+def feed_batch(outputs, line_no, lines):
+    errors = []
+    for output in outputs:
+        try:
+            output.feed_lines(lines)
+        except InvalidCONLLUPToken as e:
+            errors.append((output.position, str(e)))
+
+    if errors:
+        # report the first invalid line, just like when feeding line by line
+        position, error = min(errors)
+        raise TypeError('Line number {}: {}'.format(line_no + position, error))
+
+
+def feed_lines(outputs, lines):
+    for line_no, line in lines:
+        try:
+            for output in outputs:
+                output.feed(line)
+        except InvalidCONLLUPToken as e:
+            raise TypeError('Line number {}: {}'.format(line_no, str(e)))
+
+
+def generate(input_stream, output_stream, datasets=[], omit_datasets=[], annotations=[], omit_annotations=[],
+             misc=[], keep_status=False, index=None, filter_expression=None, stats=None):
+    # output_stream can also be a mapping of dataset name to output stream, in which case every document (or sentence
+    # of a partially contained document) is routed to the outputs of all the datasets it is contained in
+    # with a CONLLUPIndex of the (seekable) input stream, documents that no output needs are not read at all
+    # input_stream can also be a CONLLUPMappedReader, which feeds lines in batches and skips flushed regions
+    # filter_expression (see conllup_filter.py) further limits the documents and sentences selected by the other filters
+    # with a conllup_stats.Stats, lines read, bytes written, reading and writing time and the counts of every output
+    # are recorded
+    if stats is not None:
+        output_stream = stats.writer(output_stream)
+    outputs = create_outputs(output_stream, misc, datasets, omit_datasets, annotations, omit_annotations, keep_status,
+                             filter_expression)
+
+    if isinstance(input_stream, CONLLUPMappedReader):
+        batches = input_stream.batches(lambda: skip_marks(outputs))
+        for line_no, lines in batches if stats is None else stats.batches(batches):
+            feed_batch(outputs, line_no, lines)
+
+    elif index is not None:
+        documents = selected_documents(index, outputs)
+        if stats is not None:
+            stats.count('documents_skipped_by_index', len(index.documents) - len(documents))
+        batches = index.iter_batches(input_stream, documents)
+        for line_no, lines in batches if stats is None else stats.batches(batches):
+            feed_batch(outputs, line_no, lines)
+
+    else:
+        lines = enumerate(input_stream, 1)
+        feed_lines(outputs, lines if stats is None else stats.lines(lines))
+
+    if stats is not None:
+        count_outputs(stats, output_stream, [output.counts for output in outputs])
+
+
+def generate_documents(input_stream, datasets=[], omit_datasets=[], annotations=[], omit_annotations=[], misc=[],
+                       keep_status=False, filter_expression=None, stats=None):
+    # Same as generate, but yields the output of every document separately instead of writing it. The input is cut
+    # before each # newdoc line and fed to the generator one document at a time, so the first output is that of the
+    # lines before the first document (usually empty) and documents dropped by the filters yield empty outputs.
+    output_stream = StringIO()
+    outputs = create_outputs(output_stream, misc, datasets, omit_datasets, annotations, omit_annotations, keep_status,
+                             filter_expression)
+
+    def take(line_no, lines):
+        feed_batch(outputs, line_no, lines)
+        value = output_stream.getvalue()
+        output_stream.seek(0)
+        output_stream.truncate()
+        return value
+
+    document = []
+    document_line = 1
+    lines = enumerate(input_stream, 1)
+    for line_no, line in lines if stats is None else stats.lines(lines):
+        if line.startswith(DOCUMENT_END_MARKS):
+            yield take(document_line, document)
+            document = []
+            document_line = line_no
+        document.append(line)
+    yield take(document_line, document)
+
+    if stats is not None:
+        count_outputs(stats, output_stream, [output.counts for output in outputs])
+
+
+def count_outputs(stats, output_stream, counts):
+    # adds the counts of every output, prefixed with the dataset name when routing output by dataset
+    prefixes = ['{}.'.format(dataset) for dataset in output_stream] if isinstance(output_stream, dict) else ['']
+    for prefix, output_counts in zip(prefixes, counts):
+        stats.update(output_counts, prefix)
+        if prefix:
+            stats.count('tokens', output_counts['tokens'])
+
+
+def generate_shard(source, blocks, split_datasets, options):
+    # converts the given blocks of the source file, returns the output and the counts of every split (or the only
+    # output)
+    output_streams = OrderedDict([(dataset, StringIO()) for dataset in split_datasets]) if split_datasets else StringIO()
+    outputs = create_outputs(output_streams, **options)
+
+    with open(source, 'r') as infile:
+        for line_no, lines in iter_block_batches(infile, blocks):
+            feed_batch(outputs, line_no, lines)
+
+    return [output.output_stream.getvalue() for output in outputs], [output.counts for output in outputs]
+
+
+def shard_documents(documents, shards):
+    # cuts documents into contiguous shards of roughly the same size in bytes
+    total = sum([d['end'] - d['offset'] for d in documents])
+    shard_size = max(1, total // shards)
+    shard = []
+    size = 0
+    for document in documents:
+        shard.append(document)
+        size += document['end'] - document['offset']
+        if size >= shard_size:
+            yield shard
+            shard = []
+            size = 0
+    if shard:
+        yield shard
+
+
+def generate_parallel(source, output_stream, jobs, datasets=[], omit_datasets=[], annotations=[], omit_annotations=[],
+                      misc=[], keep_status=False, index=None, filter_expression=None, stats=None):
+    # same as generate, but documents of the source file are converted in a pool of jobs processes and merged back in
+    # the original order
+    index = index or CONLLUPIndex.get(source)
+    if stats is not None:
+        output_stream = stats.writer(output_stream)
+    options = {'misc': misc, 'datasets': datasets, 'omit_datasets': omit_datasets, 'annotations': annotations,
+               'omit_annotations': omit_annotations, 'keep_status': keep_status,
+               'filter_expression': filter_expression}
+    split_datasets = list(output_stream.keys()) if isinstance(output_stream, dict) else []
+    output_streams = list(output_stream.values()) if split_datasets else [output_stream]
+
+    documents = selected_documents(index, create_outputs(output_stream, **options))
+    shards = [[index.preamble()]] + list(shard_documents(documents, jobs * SHARDS_PER_JOB))
+
+    with ProcessPoolExecutor(jobs) as executor:
+        results = executor.map(generate_shard, repeat(source), shards, repeat(split_datasets), repeat(options))
+        for values, counts in results:
+            for stream, value in zip(output_streams, values):
+                stream.write(value)
+            if stats is not None:
+                count_outputs(stats, output_stream, counts)
+
+
+def manifest_filename(output_file):
+    return '{}{}'.format(output_file, MANIFEST_EXTENSION)
+
+
+def load_manifest(output_file, options):
+    # maps the hash of every document to the byte range of its output in the previous output file, empty if there is
+    # no manifest or the output was generated with other options or changed since
+    try:
+        with open(manifest_filename(output_file), 'r') as f:
+            data = json.load(f)
+        size = os.path.getsize(output_file)
+    except (OSError, ValueError):
+        return {}
+
+    if data.get('version') != MANIFEST_VERSION or data['options'] != options or data['size'] != size:
+        return {}
+    return {sha1: (offset, length) for sha1, offset, length in data['documents']}
+
+
+def save_manifest(output_file, options, size, documents):
+    with open(manifest_filename(output_file), 'w') as f:
+        json.dump({
+            'version': MANIFEST_VERSION,
+            'options': options,
+            'size': size,
+            'documents': documents
+        }, f)
+
+
+def take_output(outputs):
+    # converted content of every output since the last call
+    values = []
+    for output in outputs:
+        values.append(output.output_stream.getvalue().encode('utf-8'))
+        output.output_stream.seek(0)
+        output.output_stream.truncate()
+    return values
+
+
+def generate_incremental(source, output_file, datasets=[], omit_datasets=[], annotations=[], omit_annotations=[],
+                         misc=[], keep_status=False, index=None, filter_expression=None, stats=None):
+    # same as generate, but a manifest of the hashes of the converted documents is kept next to the output file and
+    # documents whose source is unchanged since the previous run are copied from the previous output file
+    # output_file can also be a mapping of dataset name to output file, returns the numbers of converted and copied
+    # documents
+    index = index or CONLLUPIndex.get(source)
+    options = {'misc': misc, 'datasets': datasets, 'omit_datasets': omit_datasets, 'annotations': annotations,
+               'omit_annotations': omit_annotations, 'keep_status': keep_status,
+               'filter_expression': filter_expression}
+    split_datasets = list(output_file.keys()) if isinstance(output_file, dict) else []
+    output_files = list(output_file.values()) if split_datasets else [output_file]
+    output_streams = OrderedDict([(dataset, StringIO()) for dataset in split_datasets]) if split_datasets else StringIO()
+    outputs = create_outputs(output_streams, **options)
+
+    manifest_options = [{'dataset': dataset, 'misc': list(misc), 'datasets': sorted(datasets),
+                         'omit_datasets': sorted(omit_datasets), 'annotations': sorted(annotations),
+                         'omit_annotations': sorted(omit_annotations), 'keep_status': keep_status,
+                         'filter_expression': filter_expression} for dataset in split_datasets or [None]]
+    manifests = [load_manifest(filename, manifest_option)
+                 for filename, manifest_option in zip(output_files, manifest_options)]
+    sizes = [0 for _ in output_files]
+    entries = [[] for _ in output_files]
+    converted = 0
+    copied = 0
+
+    with ExitStack() as stack:
+        reader = stack.enter_context(CONLLUPMappedReader(source))
+        previous_files = [stack.enter_context(open(filename, 'rb')) if manifest else None
+                          for filename, manifest in zip(output_files, manifests)]
+        new_files = [stack.enter_context(open('{}.tmp'.format(filename), 'wb')) for filename in output_files]
+
+        preamble = index.preamble()
+        feed_batch(outputs, preamble['line'], reader.read_lines(preamble['offset'], preamble['end']))
+        for i, value in enumerate(take_output(outputs)):
+            new_files[i].write(value)
+            sizes[i] += len(value)
+
+        for document in selected_documents(index, outputs):
+            sha1 = hashlib.sha1(reader.map[document['offset']:document['end']]).hexdigest()
+            if all([sha1 in manifest for manifest in manifests]):
+                values = []
+                for previous_file, manifest in zip(previous_files, manifests):
+                    offset, length = manifest[sha1]
+                    previous_file.seek(offset)
+                    values.append(previous_file.read(length))
+                copied += 1
+            else:
+                feed_batch(outputs, document['line'], reader.read_lines(document['offset'], document['end']))
+                values = take_output(outputs)
+                converted += 1
+
+            for i, value in enumerate(values):
+                new_files[i].write(value)
+                entries[i].append([sha1, sizes[i], len(value)])
+                sizes[i] += len(value)
+
+    for filename, manifest_option, size, documents in zip(output_files, manifest_options, sizes, entries):
+        os.replace('{}.tmp'.format(filename), filename)
+        save_manifest(filename, manifest_option, size, documents)
+
+    if stats is not None:
+        stats.count('documents_converted', converted)
+        stats.count('documents_copied', copied)
+        stats.count('bytes_written', sum(sizes))
+        count_outputs(stats, output_file, [output.counts for output in outputs])
+    return converted, copied
+
+
+def open_source(source, index=None, jobs=1):
+    if not is_plain_file(source):
+        # compressed file or stdin
+        return open_input(source)
+    if index is not None or jobs > 1:
+        # offsets of the index are read from a regular file object
+        return open(source, 'r')
+    return CONLLUPMappedReader(source)
+
+
+def main(args, stats=None):
+    index = None
+    if args.index or args.jobs > 1 or args.incremental:
+        with stage(stats, 'index'):
+            index = CONLLUPIndex.get(args.source)
     datasets = set(args.datasets)
     omit_datasets = set(args.omit_datasets)
     annotations = set(args.annotations)
     omit_annotations = set(args.omit_annotations)
 
-    with open(args.source, 'r') as infile, open(output_file, 'w') as outfile:
-        generate(infile, outfile, datasets, omit_datasets, annotations, omit_annotations, args.misc, args.keep_status)
+    if args.splits:
+        split_outputs = OrderedDict([split.split('=', 1) for split in args.splits])
+        if args.incremental:
+            generate_incremental(args.source, split_outputs, omit_datasets=omit_datasets, annotations=annotations,
+                                 omit_annotations=omit_annotations, misc=args.misc, keep_status=args.keep_status,
+                                 index=index, filter_expression=args.filter, stats=stats)
+            return
+
+        with ExitStack() as stack:
+            infile = stack.enter_context(open_source(args.source, index, args.jobs))
+            outfiles = OrderedDict([(dataset, stack.enter_context(open_output(output_file)))
+                                    for dataset, output_file in split_outputs.items()])
+            if args.jobs > 1:
+                generate_parallel(args.source, outfiles, args.jobs, omit_datasets=omit_datasets,
+                                  annotations=annotations, omit_annotations=omit_annotations, misc=args.misc,
+                                  keep_status=args.keep_status, index=index, filter_expression=args.filter,
+                                  stats=stats)
+            else:
+                generate(infile, outfiles, omit_datasets=omit_datasets, annotations=annotations,
+                         omit_annotations=omit_annotations, misc=args.misc, keep_status=args.keep_status, index=index,
+                         filter_expression=args.filter, stats=stats)
+        return
+
+    output_file = args.output_file
+    if not output_file:
+        output_file = STDIO if args.source == STDIO else '{}.conllu'.format(
+            os.path.splitext(strip_compression_extension(args.source))[0]
+        )
+
+    if args.incremental:
+        generate_incremental(args.source, output_file, datasets, omit_datasets, annotations, omit_annotations,
+                             args.misc, args.keep_status, index, args.filter, stats)
+        return
+
+    with open_source(args.source, index, args.jobs) as infile, open_output(output_file) as outfile:
+        if args.jobs > 1:
+            generate_parallel(args.source, outfile, args.jobs, datasets, omit_datasets, annotations, omit_annotations,
+                              args.misc, args.keep_status, index, args.filter, stats)
+        else:
+            generate(infile, outfile, datasets, omit_datasets, annotations, omit_annotations, args.misc,
+                     args.keep_status, index, args.filter, stats)
 
 
 if __name__ == '__main__':
@@ -283,8 +700,10 @@ if __name__ == '__main__':
         description='Generates corpus in .conllu format from .conllup source',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
-    parser.add_argument('source', help='Path to the source file.')
-    parser.add_argument('-o', dest='output_file', help='Path to the output file.')
+    parser.add_argument('source', help='Path to the source file (.gz, .bz2, .xz and .zst are decompressed, - reads '
+                                       'from stdin).')
+    parser.add_argument('-o', dest='output_file', help='Path to the output file (compressed by extension, - writes to '
+                                                       'stdout).')
     parser.add_argument('-d', '--datasets', type=str, nargs='*', default=[],
                         help='Filter documents by containment in datasets.')
     parser.add_argument('-t', '--omit-datasets', type=str, nargs='*', default=[],
@@ -293,10 +712,41 @@ if __name__ == '__main__':
                         help='Filter documents by level of annotation.')
     parser.add_argument('-n', '--omit-annotations', type=str, nargs='*', default=[],
                         help='Filter documents by not having certain level of annotation.')
+    parser.add_argument('-f', '--filter', metavar='EXPRESSION',
+                        help='Filter documents and sentences by an expression over datasets and annotation levels, '
+                             'e.g. "datasets: (hr500k-train | ud-train) & !ud-test; annotations: NE & DP".')
     parser.add_argument('-m', '--misc', type=str, nargs='*', default=[],
                         choices=['NE', 'DP', 'SRL', 'PARSEME', 'RMISC'],
                         help='Transfer data from these columns to MISC.')
     parser.add_argument('--keep-status-metadata', dest='keep_status', action='store_true',
                         help='Write document status metadata to output file.')
+    parser.add_argument('-s', '--splits', type=str, nargs='*', default=[], metavar='DATASET=OUTPUT_FILE',
+                        help='Write documents of each dataset to its own output file in a single pass.')
+    parser.add_argument('--index', action='store_true',
+                        help='Use (and build if missing or out of date) the byte offset index next to the source file '
+                             'to skip filtered out documents without reading them.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Convert documents in this many processes (uses the index).')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Keep a manifest of document hashes next to each output file and convert only the '
+                             'documents that changed since the previous run (uses the index).')
+    add_stats_arguments(parser)
     args = parser.parse_args()
-    main(args)
+
+    if args.splits and (args.output_file or args.datasets):
+        parser.error('argument -s/--splits: not allowed with argument -o or -d/--datasets')
+    if any(['=' not in split for split in args.splits]):
+        parser.error('argument -s/--splits: expected DATASET=OUTPUT_FILE pairs')
+    if args.filter:
+        try:
+            compile_filters(args.filter)
+        except InvalidFilterExpression as e:
+            parser.error('argument -f/--filter: {}'.format(e))
+    if (args.index or args.jobs > 1) and not is_plain_file(args.source):
+        parser.error('arguments --index and -j/--jobs require an uncompressed source file')
+    if args.incremental and not is_plain_file(args.source):
+        parser.error('argument --incremental requires an uncompressed source file')
+    output_files = [args.output_file or ''] + [split.split('=', 1)[-1] for split in args.splits]
+    if args.incremental and any([f == STDIO or compression_from_extension(f) for f in output_files]):
+        parser.error('argument --incremental requires uncompressed output files')
+    run_with_stats(main, args)
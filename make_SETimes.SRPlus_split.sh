@@ -1,5 +1,6 @@
 #!/bin/bash
 
-python3 generate_conllu.py SETimes.SRPlus/set.sr.plus.conllup -o SETimes.SRPlus/set.sr.plus-train.conllu -d set.sr.plus-train -m NE
-python3 generate_conllu.py SETimes.SRPlus/set.sr.plus.conllup -o SETimes.SRPlus/set.sr.plus-dev.conllu -d set.sr.plus-dev -m NE
-python3 generate_conllu.py SETimes.SRPlus/set.sr.plus.conllup -o SETimes.SRPlus/set.sr.plus-test.conllu -d set.sr.plus-test -m NE
+python3 generate_conllu.py SETimes.SRPlus/set.sr.plus.conllup -m NE -s \
+    set.sr.plus-train=SETimes.SRPlus/set.sr.plus-train.conllu \
+    set.sr.plus-dev=SETimes.SRPlus/set.sr.plus-dev.conllu \
+    set.sr.plus-test=SETimes.SRPlus/set.sr.plus-test.conllu
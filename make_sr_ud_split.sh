@@ -1,5 +1,6 @@
 #!/bin/bash
 
-python3 generate_conllu.py SETimes.SRPlus/set.sr.plus.conllup -o SETimes.SRPlus/sr_set-ud-train.conllu -d sr_set-ud-train
-python3 generate_conllu.py SETimes.SRPlus/set.sr.plus.conllup -o SETimes.SRPlus/sr_set-ud-dev.conllu -d sr_set-ud-dev
-python3 generate_conllu.py SETimes.SRPlus/set.sr.plus.conllup -o SETimes.SRPlus/sr_set-ud-test.conllu -d sr_set-ud-test
+python3 generate_conllu.py SETimes.SRPlus/set.sr.plus.conllup -s \
+    sr_set-ud-train=SETimes.SRPlus/sr_set-ud-train.conllu \
+    sr_set-ud-dev=SETimes.SRPlus/sr_set-ud-dev.conllu \
+    sr_set-ud-test=SETimes.SRPlus/sr_set-ud-test.conllu
@@ -1,64 +1,143 @@
 import argparse
 import os
 import re
-import uuid
 
+from collections import Counter, namedtuple
+from compressed_io import open_input, STDIO, strip_compression_extension
 from conll_corpus_splitter.conll_corpus_splitter import CONLLCorpusIterator, split_corpus, COMMENT_PATTERN
 from conll_corpus_splitter.conll_corpus_splitter.utils import MetadataDiffDict
-from contextlib import ExitStack
-from generate_conllu import generate
+from conllup_reader import CONLLUPMappedReader
+from conllup_stats import add_stats_arguments, run_with_stats, stage
+from functools import partial
+from generate_conllu import generate_documents
+
+
+class DocumentSpan(namedtuple('DocumentSpan', ['filename', 'start', 'end'])):
+    # byte range of a document in a .conllu file, its text is read only when needed
+
+    def read(self, reader=None):
+        # decoded text of the document, from a CONLLUPMappedReader of the file or by opening it
+        if reader is not None:
+            return reader.map[self.start:self.end].decode(reader.encoding)
+        with open(self.filename, 'rb') as f:
+            f.seek(self.start)
+            return f.read(self.end - self.start).decode('utf-8')
+
+
+def read_spans(spans):
+    # texts of the documents, every file is mapped once while its consecutive spans are read
+    reader = None
+    try:
+        for span in spans:
+            if reader is None or reader.filename != span.filename:
+                if reader is not None:
+                    reader.close()
+                reader = CONLLUPMappedReader(span.filename)
+            yield span.read(reader)
+    finally:
+        if reader is not None:
+            reader.close()
 
 
 class CONLLCorpusDocumentIterator(CONLLCorpusIterator):
+    # Documents of .conllu files, each from a line matching the sample start pattern to the next one or to the end of
+    # the file (lines before the first document are skipped). Each file is scanned once for the document starts unless
+    # the spans of the documents are already known, documents are decoded one at a time from the memory-mapped file as
+    # they are iterated.
+
     def __init__(self, *filenames, sample_start_pattern=r'^#\snewdoc\sid\s?=',
-                 comment_pattern=COMMENT_PATTERN, ignore_metadata_attributes=['global.columns']):
+                 comment_pattern=COMMENT_PATTERN, ignore_metadata_attributes=['global.columns'], spans=None):
         super().__init__(*filenames, sample_start_pattern=sample_start_pattern, sample_end_pattern=sample_start_pattern,
                          comment_pattern=comment_pattern, ignore_metadata_attributes=ignore_metadata_attributes,
                          append_newline=False)
+        self.start_re = re.compile(sample_start_pattern.encode('utf-8'), re.MULTILINE)
+        self.known_spans = spans
+
+    def spans(self):
+        if self.known_spans is not None:
+            yield from self.known_spans
+            return
+        for filename in self.filenames:
+            with CONLLUPMappedReader(filename) as reader:
+                starts = [match.start() for match in self.start_re.finditer(reader.map)]
+            for start, end in zip(starts, starts[1:] + [reader.size]):
+                yield DocumentSpan(filename, start, end)
 
     def __iter__(self):
-        with ExitStack() as stack:
-            files = [stack.enter_context(open(filename, 'r')) for filename in self.filenames]
-            line_index = -1
-            for file in files:
-                text_buffer = ''
-                metadata = MetadataDiffDict()
-                reading_sample = False
-                for line in file:
-                    line_index += 1
-                    if re.match(self.sample_start_pattern, line) and reading_sample:
-                        # end of sample
-                        yield text_buffer, metadata.copy()
-                        reading_sample = True
-                        text_buffer = line
-                        metadata = MetadataDiffDict()
-                    elif re.match(self.sample_start_pattern, line):
-                        # start of sample
-                        reading_sample = True
-                        text_buffer += line
-                        metadata = MetadataDiffDict()
-                    elif reading_sample:
-                        text_buffer += line
-
-
-def main(args):
-    intermediate_filename = str(uuid.uuid4().hex)
-    if args.keep_conllu:
-        intermediate_filename = '{}.conllu'.format(os.path.splitext(args.source)[0])
+        for text in read_spans(self.spans()):
+            yield text, MetadataDiffDict()
+
+
+class GeneratedDocumentIterator(CONLLCorpusDocumentIterator):
+    # documents as the generator yields them, nothing is written or read back, split_corpus still passes the name of
+    # the corpus, which is not scanned
+    def __init__(self, *filenames, documents=(), **kwargs):
+        super().__init__(*filenames, **kwargs)
+        self.documents = documents
 
+    def __iter__(self):
+        for text in self.documents:
+            yield text, MetadataDiffDict()
+
+
+def conllu_filename(source):
+    # name of the generated .conllu corpus, the split outputs are named after it
+    if source == STDIO:
+        return 'corpus.conllu'
+    return '{}.conllu'.format(os.path.splitext(strip_compression_extension(source))[0])
+
+
+def write_corpus(documents, filename, stats=None):
+    # writes the generated documents to the .conllu corpus, spans of the documents starting with # newdoc
+    spans = []
+    offset = 0
+    with open(filename, 'wb') as outfile:
+        for document in documents:
+            data = document.encode('utf-8')
+            with stage(stats, 'write'):
+                outfile.write(data)
+            if document.startswith('# newdoc'):
+                spans.append(DocumentSpan(filename, offset, offset + len(data)))
+            offset += len(data)
+    if stats is not None:
+        stats.count('bytes_written', offset)
+    return spans
+
+
+def main(args, stats=None):
+    corpus_filename = conllu_filename(args.source)
     datasets = set(args.datasets)
     omit_datasets = set(args.omit_datasets)
     annotations = set(args.annotations)
     omit_annotations = set(args.omit_annotations)
+    counts = Counter()
+
+    def split_documents(documents):
+        for document in documents:
+            if document.startswith('# newdoc'):
+                counts['split_documents'] += 1
+                yield document
 
-    with open(args.source, 'r') as infile, open(intermediate_filename, 'w') as outfile:
-        generate(infile, outfile, datasets=datasets, omit_datasets=omit_datasets, annotations=annotations,
-                 omit_annotations=omit_annotations, misc=args.misc, keep_status=args.keep_status)
+    # Documents go from the generator straight into the splitter, no .conllu corpus is written. With --keep-conllu the
+    # corpus is written first and the splitter reads the documents back by the byte spans the generator cut them at.
+    with open_input(args.source) as infile:
+        documents = generate_documents(infile, datasets=datasets, omit_datasets=omit_datasets, annotations=annotations,
+                                       omit_annotations=omit_annotations, misc=args.misc, keep_status=args.keep_status,
+                                       stats=stats)
+        if args.keep_conllu:
+            spans = write_corpus(documents, corpus_filename, stats)
+            counts['split_documents'] = len(spans)
+            iterator_cls = partial(CONLLCorpusDocumentIterator, spans=spans)
+        else:
+            iterator_cls = partial(GeneratedDocumentIterator, documents=split_documents(documents))
 
-    output_folder = args.output_folder or os.getcwd()
-    split_corpus(intermediate_filename, output_folder=output_folder, test=args.test, dev=args.dev,
-                 seed=args.seed, cross_validation=args.cross_validation, omit_metadata=True,
-                 output_filename=args.output_filename, iterator_cls=CONLLCorpusDocumentIterator)
+        output_folder = args.output_folder or os.getcwd()
+        with stage(stats, 'split'):
+            split_corpus(corpus_filename, output_folder=output_folder, test=args.test, dev=args.dev,
+                         seed=args.seed, cross_validation=args.cross_validation, omit_metadata=True,
+                         output_filename=args.output_filename, iterator_cls=iterator_cls)
+    if stats is not None:
+        stats.update(counts)
 
 
 if __name__ == '__main__':
@@ -70,12 +149,13 @@ if __name__ == '__main__':
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
     io_group = parser.add_argument_group("Input / output options")
-    io_group.add_argument('source', help='Path to the source .conllup file.')
+    io_group.add_argument('source', help='Path to the source .conllup file (compressed files are decompressed, - reads '
+                                         'from stdin).')
     io_group.add_argument('-o', dest='output_folder', help='Path to the output folder.')
     io_group.add_argument('-f', '--output-filename', dest='output_filename', type=str,
                           help='Specify the filename for output files.')
-    io_group.add_argument('--keep-conllu', dest='keep_conllu', action='store_false',
-                          help='Keep intermediate .conllu file.')
+    io_group.add_argument('--keep-conllu', dest='keep_conllu', action='store_true',
+                          help='Also write the generated .conllu corpus next to the source file.')
 
     generate_group = parser.add_argument_group(".conllu generation options")
     generate_group.add_argument('-e', '--datasets', type=str, nargs='*', default=[],
@@ -98,5 +178,6 @@ if __name__ == '__main__':
     split_group.add_argument('-s', '--seed', type=int, help='Manually set random seed.')
     split_group.add_argument('--cross-validation', dest='cross_validation', action='store_true',
                              help='Create k-fold cross-validation datasets.')
+    add_stats_arguments(parser.add_argument_group("Instrumentation options"))
     args = parser.parse_args()
-    main(args)
+    run_with_stats(main, args)
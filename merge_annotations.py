@@ -0,0 +1,251 @@
+import argparse
+import json
+import re
+import sys
+
+from annotation_store import open_annotations
+from collections import Counter, OrderedDict
+from compressed_io import open_input, open_output, STDIO
+from conllup_stats import add_stats_arguments, run_with_stats, stage
+from conllup_validator import ANNOTATION_COLUMNS, COLUMNS, NULL_VALUES
+from contextlib import ExitStack
+
+
+SENTENCE_ID_RE = re.compile(r'(?<=(?:# sent_id = ))(.+)(?=\n)')
+
+# short names of the annotation columns, as in generate_conllu.py --misc
+LAYER_COLUMNS = OrderedDict([('NE', 'RELDI:NE'), ('DP', 'RELDI:DP'), ('SRL', 'RELDI:SRL'), ('PARSEME', 'PARSEME:MWE'),
+                             ('RMISC', 'RELDI:MISC')])
+# value of a token left out of an annotated sentence and the values a layer may replace without a conflict
+EMPTY_VALUES = {'RELDI:NE': 'O', 'PARSEME:MWE': '*'}
+UNSET_VALUES = {COLUMNS[column]: null_values for column, _, null_values in ANNOTATION_COLUMNS}
+POLICIES = ['overwrite', 'keep', 'fail']
+REPORT_EXAMPLES = 20
+
+
+class MergeConflict(Exception):
+    pass
+
+
+def column_name(name):
+    column = LAYER_COLUMNS.get(name, name)
+    if column not in COLUMNS[2:]:
+        raise ValueError('unknown column {!r}, expected one of {}'.format(
+            name, ', '.join(list(LAYER_COLUMNS) + COLUMNS[2:])))
+    return column
+
+
+class Layer:
+    # Values of one column from one annotation source. A sentence of the source replaces the column of all its tokens,
+    # tokens left out get the empty value of the column. A value replacing a different, non-empty one is a conflict,
+    # which is overwritten, kept or fails the merge, depending on the policy.
+
+    def __init__(self, column, source, store, policy='overwrite'):
+        self.column = column
+        self.index = COLUMNS.index(column)
+        self.source = source
+        self.store = store
+        self.policy = policy
+        self.empty = EMPTY_VALUES.get(column, '_')
+        self.unset = UNSET_VALUES.get(column, NULL_VALUES)
+        self.counts = Counter()
+        self.merged = set()
+        self.examples = OrderedDict([('conflict_examples', []), ('form_mismatch_examples', [])])
+
+    def bind(self, columns):
+        # position of the column in the # global.columns of the merged file
+        if self.column not in columns:
+            raise ValueError('Column {} is not in the # global.columns of the source.'.format(self.column))
+        self.index = columns.index(self.column)
+
+    def example(self, kind, **details):
+        if len(self.examples[kind]) < REPORT_EXAMPLES:
+            self.examples[kind].append(OrderedDict(details))
+
+    def merge(self, sentence_id, rows, tokens):
+        self.merged.add(sentence_id)
+        self.counts['sentences_merged'] += 1
+        values = {index: (form, value) for index, form, value in rows}
+        for columns in tokens:
+            form, value = values.pop(columns[0], ('', self.empty))
+            if form and form != columns[1]:
+                self.counts['form_mismatches'] += 1
+                self.example('form_mismatch_examples', sentence=sentence_id, token=columns[0], expected=form,
+                             found=columns[1])
+
+            current = columns[self.index]
+            if current == value:
+                self.counts['tokens_unchanged'] += 1
+                continue
+            if current not in self.unset:
+                self.counts['conflicts'] += 1
+                self.example('conflict_examples', sentence=sentence_id, token=columns[0], current=current, value=value)
+                if self.policy == 'fail':
+                    raise MergeConflict('Sentence {}, token {}: {} {!r} from {} conflicts with {!r}.'.format(
+                        sentence_id, columns[0], self.column, value, self.source, current))
+                if self.policy == 'keep':
+                    self.counts['conflicts_kept'] += 1
+                    continue
+            columns[self.index] = value
+            self.counts['tokens_set'] += 1
+        self.counts['unknown_tokens'] += len(values)
+
+    def report(self):
+        report = OrderedDict([('column', self.column), ('source', self.source), ('policy', self.policy),
+                              ('sentences', len(self.store))])
+        for name in ['sentences_merged', 'tokens_set', 'tokens_unchanged', 'conflicts', 'conflicts_kept',
+                     'form_mismatches', 'unknown_tokens']:
+            report[name] = self.counts[name]
+        report['missing_sentences'] = [sentence_id for sentence_id in self.store if sentence_id not in self.merged]
+        report.update(self.examples)
+        return report
+
+
+def merge_layers(input_stream, output_stream, layers):
+    # Applies all layers in one pass. Lines of sentences without annotations in any of the layers are written as they
+    # are, only the token lines of annotated sentences are split into columns.
+    names = COLUMNS
+    sentence_id = None
+    annotated = []
+    tokens = []
+
+    def flush():
+        for layer, rows in annotated:
+            layer.merge(sentence_id, rows, tokens)
+        output_stream.write(''.join('{}\n'.format('\t'.join(columns)) for columns in tokens))
+
+    for line_no, line in enumerate(input_stream, 1):
+        if line.startswith('#'):
+            if line.startswith('# sent_id'):
+                sentence_id = SENTENCE_ID_RE.search(line).group(0)
+                annotated = [(layer, rows) for layer, rows in ((layer, layer.store.get(sentence_id))
+                                                               for layer in layers) if rows is not None]
+            elif line.startswith('# global.columns'):
+                names = line.split('=', 1)[1].split()
+                for layer in layers:
+                    layer.bind(names)
+            output_stream.write(line)
+
+        elif not line.strip():
+            if annotated:
+                flush()
+            sentence_id = None
+            annotated = []
+            tokens = []
+            output_stream.write(line)
+
+        elif annotated:
+            columns = line.rstrip('\n').split('\t')
+            if len(columns) != len(names):
+                raise ValueError('Line {}: expected {} columns, got {}.'.format(line_no, len(names), len(columns)))
+            tokens.append(columns)
+
+        else:
+            output_stream.write(line)
+
+    if annotated:
+        flush()
+
+
+def parse_layer(spec):
+    # (column, path) of a COLUMN=PATH layer argument
+    name, _, filename = spec.partition('=')
+    if not filename:
+        raise ValueError('expected COLUMN=PATH, got {!r}'.format(spec))
+    return column_name(name), filename
+
+
+def parse_policies(values):
+    # a policy for all layers and policies of single columns given as COLUMN=POLICY
+    default = 'overwrite'
+    policies = {}
+    for value in values:
+        column, _, policy = value.rpartition('=')
+        if policy not in POLICIES:
+            raise ValueError('unknown conflict policy {!r}, expected one of {}'.format(policy, ', '.join(POLICIES)))
+        if column:
+            policies[column_name(column)] = policy
+        else:
+            default = policy
+    return default, policies
+
+
+def print_summary(reports):
+    for report in reports:
+        print('{} from {}: {} of {} sentences merged, {} tokens set, {} conflicts ({}), {} form mismatches, '
+              '{} unknown tokens, {} sentences missing from the corpus.'.format(
+                  report['column'], report['source'], report['sentences_merged'], report['sentences'],
+                  report['tokens_set'], report['conflicts'], report['policy'], report['form_mismatches'],
+                  report['unknown_tokens'], len(report['missing_sentences'])), file=sys.stderr)
+
+
+def main(args, stats=None):
+    default, policies = parse_policies(args.conflict)
+    with ExitStack() as stack:
+        layers = []
+        with stage(stats, 'load_annotations'):
+            for column, filename in map(parse_layer, args.layers):
+                store = stack.enter_context(open_annotations(filename, spill=args.spill))
+                layers.append(Layer(column, filename, store, policies.get(column, default)))
+
+        error = None
+        with stage(stats, 'merge'), open_input(args.source) as infile, open_output(args.output_file) as outfile:
+            try:
+                merge_layers(infile, outfile if stats is None else stats.writer(outfile), layers)
+            except MergeConflict as e:
+                error = e
+
+        if stats is not None:
+            for layer in layers:
+                stats.count('annotated_sentences', len(layer.store))
+                stats.update(layer.counts)
+        reports = [layer.report() for layer in layers]
+        if args.report:
+            with open(args.report, 'w', encoding='utf-8') as f:
+                json.dump(OrderedDict([('source', args.source), ('completed', error is None), ('layers', reports)]),
+                          f, indent=2, ensure_ascii=False)
+        print_summary(reports)
+
+    if error is not None:
+        print('Merge failed: {}'.format(error), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        prog='Annotation layers to CONLLUP file',
+        description='Merges annotation layers from several sources into the columns of a CONLLUP file in one pass.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('source', help='Path to the source file (compressed files are decompressed, - reads from '
+                                       'stdin).')
+    parser.add_argument('-l', '--layer', dest='layers', action='append', required=True,
+                        help='Annotation layer as COLUMN=PATH, where COLUMN is a column name or one of NE, DP, SRL, '
+                             'PARSEME and RMISC and PATH a .json file in the format of add_parseme_annotations.py or '
+                             'a .tsv file of sentence id, token id, optional form and value lines. Layers are '
+                             'applied in the given order.')
+    parser.add_argument('-c', '--conflict', action='append', default=[],
+                        help='Policy for values replacing a different non-empty value, one of {}, for all layers or '
+                             'as COLUMN=POLICY for the layers of one column. Without it, such values are '
+                             'overwritten.'.format(', '.join(POLICIES)))
+    parser.add_argument('-o', dest='output_file', default=STDIO,
+                        help='Path to the output file (compressed by extension, - writes to stdout).')
+    parser.add_argument('--report', help='Path to a JSON report of the merge with counts, conflicts and form '
+                                         'mismatches of every layer.')
+    parser.add_argument('--spill', action='store_true',
+                        help='Keep the annotation data in temporary files on disk instead of in memory.')
+    add_stats_arguments(parser)
+    args = parser.parse_args()
+
+    try:
+        for layer in args.layers:
+            parse_layer(layer)
+    except ValueError as e:
+        parser.error('argument -l/--layer: {}'.format(e))
+    try:
+        parse_policies(args.conflict)
+    except ValueError as e:
+        parser.error('argument -c/--conflict: {}'.format(e))
+    sys.exit(run_with_stats(main, args))
@@ -1,123 +1,343 @@
+import os
+import pickle
 import re
 
+from collections import namedtuple, OrderedDict
+from conllup_index import file_hash
+
+
+CACHE_SIZE = 1 << 16
+DEFAULT_MAPPING = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mte5-udv2.mapping')
+COMPILED_MAPPING_VERSION = 2
+COMPILED_MAPPING_EXTENSION = '.cache'
+MAPPING_TABLES = ('msd_upos', 'msd_mtefeat', 'msd_udfeat', 'uposudfeat_msd', 'feature_bits', 'upos_feature_masks')
+
+# Pronouns and determiners
+POSSESSIVE_INTERROGATIVES = ('čiji', 'nečiji', 'ničiji', 'svačiji', 'ičiji')
+PLURAL_POSSESSOR = ('naš', 'vaš', 'njihov')
+SINGULAR_POSSESSOR = ('moj', 'tvoj')
+FEMININE_POSSESSOR = ('njen', 'njezin')
+PRON_LEMMAS = ('svako', 'svatko', 'niko', 'nitko', 'neko', 'netko', 'iko', 'itko', 'svašta', 'ništa', 'išta', 'nešto')
+DET_LEMMAS = ('sav', 'svaki', 'svakakav', 'svačiji', 'nikakav', 'ničiji', 'neki', 'nekolik', 'nekakav', 'nečiji',
+              'ikoji', 'ičiji', 'ikakav')
+TOTAL_PRONOUNS = ('sav', 'sve', 'svako', 'svatko', 'svaki', 'svašta', 'svakakav', 'svačiji')
+NEGATIVE_PRONOUNS = ('niko', 'nitko', 'ništa', 'nikakav', 'ničiji')
+INDEFINITE_PRONOUNS = ('neko', 'netko', 'nešto', 'neki', 'nekolik', 'nekakav', 'nečiji', 'iko', 'itko', 'išta',
+                       'ikoji', 'ičiji', 'ikakav', 'pokoji', 'štošta')
+
+# Adverbs
+DEMONSTRATIVE_ADVERBS = ('sad', 'sada', 'onda', 'tad', 'tada', 'onda', 'ovde', 'ovdje', 'onde', 'ondje', 'ovamo',
+                         'tamo', 'onamo', 'ovuda', 'tuda', 'onuda', 'ovako', 'tako', 'onako', 'tu', 'stoga', 'zato',
+                         'ovoliko', 'toliko', 'onoliko')
+INTERROGATIVE_ADVERBS = ('gde', 'gdje', 'kud', 'kuda', 'kako', 'kad', 'kada', 'koliko', 'zašto', 'odakle', 'otkada')
+INDEFINITE_ADVERBS = ('nekad', 'nekada', 'ponekad', 'nekako', 'negde', 'negdje', 'nekud', 'nekuda', 'odnekud',
+                      'nekoliko', 'ikad', 'ikada', 'ikako', 'ikoliko')
+TOTAL_ADVERBS = ('uvek', 'uvijek', 'svakako', 'svuda', 'posvuda', 'svugde', 'svugdje', 'svakako')
+NEGATIVE_ADVERBS = ('nikad', 'nikada', 'nigde', 'nigdje', 'nikud', 'nikuda', 'nikad', 'nikada', 'nikako', 'nikoliko')
+
+NEGATED_AUXILIARIES = ('nisam', 'nisi', 'nije', 'nismo', 'niste', 'nisu',
+                       'neću', 'nećeš', 'neće', 'nećemo', 'nećete', 'neće',
+                       'nemam', 'nemaš', 'nema', 'nemamo', 'nemate', 'nemaju',
+                       'nemoj', 'nemojmo', 'nemojte')
+
+
+class MSDRule(namedtuple('MSDRule', ['prefix', 'edit', 'msd', 'lemmas', 'form'])):
+    # Applies edit(upos, udfeat, surface_form, lemma) -> (upos, udfeat) to MSDs starting with prefix (and passing the
+    # msd predicate), with one of the lemmas and a form passing the form predicate. None matches anything.
+    def matches(self, surface_form, lemma, msd):
+        return (msd.startswith(self.prefix) and (self.msd is None or self.msd(msd)) and
+                (self.lemmas is None or lemma in self.lemmas) and (self.form is None or self.form(surface_form)))
+
+
+def rule(prefix, edit, msd=None, lemmas=None, form=None):
+    return MSDRule(prefix, edit, msd, frozenset(lemmas) if lemmas is not None else None, form)
+
+
+def insert_before(mark, feature):
+    # inserts the feature before the mark (the last feature if the mark is missing)
+    def edit(upos, udfeat, surface_form, lemma):
+        return upos, udfeat[0:udfeat.find(mark)] + feature + '|' + udfeat[udfeat.find(mark):]
+    return edit
+
+
+def insert_psor(gender):
+    # inserts Gender[psor] before Number and Number[psor]=Sing before Person
+    def edit(upos, udfeat, surface_form, lemma):
+        return upos, udfeat[0:udfeat.find('Number')] + 'Gender[psor]={}|'.format(gender) + \
+                     udfeat[udfeat.find('Number'):udfeat.find('Person')] + 'Number[psor]=Sing|' + \
+                     udfeat[udfeat.find('Person'):]
+    return edit
+
+
+def replace_last(feature):
+    def edit(upos, udfeat, surface_form, lemma):
+        return upos, udfeat[0:udfeat.rfind('|')] + feature
+    return edit
+
+
+def set_pron_type(value, separator=''):
+    # replaces PronType and everything after it, or appends it
+    def edit(upos, udfeat, surface_form, lemma):
+        if 'PronType' in udfeat:
+            return upos, udfeat[0:udfeat.find('PronType')] + 'PronType={}'.format(value)
+        return upos, udfeat + '{}PronType={}'.format(separator, value)
+    return edit
+
+
+def append(feature):
+    def edit(upos, udfeat, surface_form, lemma):
+        return upos, udfeat + feature
+    return edit
+
+
+def set_upos(value):
+    def edit(upos, udfeat, surface_form, lemma):
+        return value, udfeat
+    return edit
+
+
+def set_features(upos_value, udfeat_value):
+    def edit(upos, udfeat, surface_form, lemma):
+        return upos if upos_value is None else upos_value, udfeat_value
+    return edit
+
+
+def cardinal_number(number):
+    def edit(upos, udfeat, surface_form, lemma):
+        if 'Number' in udfeat:
+            return upos, udfeat
+        return upos, udfeat[0:udfeat.find('NumType')] + 'Number=' + number + '|NumType=Card'
+    return edit
+
+
+def is_symbol(surface_form):
+    return '%' in surface_form or '$' in surface_form
+
+
+def has_digits(surface_form):
+    return re.search('[0-9]+', surface_form) is not None
+
+
+# Rule groups in the order they are applied. Within a group, only the first matching rule is applied.
+RULE_GROUPS = [
+    # Pronouns and determiners
+    [rule('Pi', replace_last('|Poss=Yes|PronType=Int,Rel'), lemmas=POSSESSIVE_INTERROGATIVES)],
+    [rule('Ps', insert_before('Person', 'Number[psor]=Plur'), lemmas=PLURAL_POSSESSOR),
+     rule('Ps', insert_before('Person', 'Number[psor]=Sing'), lemmas=SINGULAR_POSSESSOR),
+     rule('Ps', insert_psor('Masc,Neut'), lemmas=['njegov']),
+     rule('Ps', insert_psor('Fem'), lemmas=FEMININE_POSSESSOR)],
+    [rule('P', set_upos('PRON'), lemmas=PRON_LEMMAS),
+     rule('P', set_upos('DET'), lemmas=DET_LEMMAS)],
+    [rule('P', set_pron_type('Tot'), lemmas=TOTAL_PRONOUNS),
+     rule('P', set_pron_type('Neg'), lemmas=NEGATIVE_PRONOUNS),
+     rule('P', set_pron_type('Ind', '|'), lemmas=INDEFINITE_PRONOUNS)],
+
+    # Adverbs
+    [rule('Rr', set_features(None, 'Tense=Pres|VerbForm=Conv'), msd=lambda msd: msd == 'Rr',
+          form=lambda surface_form: surface_form.endswith('ći')),
+     rule('Rr', set_features(None, 'Tense=Past|VerbForm=Conv'), msd=lambda msd: msd == 'Rr',
+          form=lambda surface_form: surface_form.endswith('ši')),
+     rule('Rg', append('|PronType=Dem'), lemmas=DEMONSTRATIVE_ADVERBS),
+     rule('Rg', append('|PronType=Int,Rel'), lemmas=INTERROGATIVE_ADVERBS),
+     rule('Rg', append('|PronType=Ind'), lemmas=INDEFINITE_ADVERBS),
+     rule('Rg', append('|PronType=Tot'), lemmas=TOTAL_ADVERBS),
+     rule('Rg', append('|PronType=Neg'), lemmas=NEGATIVE_ADVERBS)],
+
+    # Numbers
+    [rule('Mlc', cardinal_number('Sing'), msd=lambda msd: msd != 'Mlc', lemmas=['jedan']),
+     rule('Mlc', cardinal_number('Plur'), msd=lambda msd: msd != 'Mlc'),
+     rule('Mlo', insert_before('Gender', 'Degree=Pos'))],
+
+    # Verbs
+    [rule('Va', insert_before('Tense', 'Polarity=Neg'), form=lambda surface_form: surface_form in NEGATED_AUXILIARIES)],
+
+    # Other
+    [rule('', set_features('SYM', 'NumType=Mult'), form=lambda surface_form: is_symbol(surface_form) and
+          has_digits(surface_form)),
+     rule('', set_features('SYM', '_'), form=is_symbol)],
+]
+
+
+def compile_rules(rule_groups):
+    # dispatch table of the rule groups that can apply to MSDs of each category (first letter), rules with an empty
+    # prefix apply to all categories and are also stored under None for categories without rules of their own
+    categories = set(r.prefix[:1] for group in rule_groups for r in group if r.prefix)
+    dispatch = {}
+    for category in list(categories) + [None]:
+        groups = []
+        for group in rule_groups:
+            group = [r for r in group if not r.prefix or r.prefix[0] == category]
+            if group:
+                groups.append(group)
+        dispatch[category] = groups
+    return dispatch
+
+
+def compiled_mapping_filename(link):
+    return '{}{}'.format(link, COMPILED_MAPPING_EXTENSION)
+
+
+def split_features(udfeat):
+    return [] if udfeat in ('', '_') else udfeat.split('|')
+
+
+def parse_mapping(link):
+    # besides the forward tables, builds the reverse index of UPOS|Feats to the set of MSDs and the feature bitset
+    # index: every Name=Value feature of the mapping gets a bit and each UPOS a list of (features mask, MSD) pairs
+    tables = {name: {} for name in MAPPING_TABLES}
+    feature_bits = tables['feature_bits']
+    with open(link, 'r', encoding='utf-8') as mapfile:
+        for line in mapfile:
+            parts = line.strip().split('\t')
+            tables['msd_upos'][parts[0]] = parts[1]
+            tables['msd_mtefeat'][parts[0]] = parts[2]
+            tables['msd_udfeat'][parts[0]] = parts[3]
+            tables['uposudfeat_msd'].setdefault('{}|{}'.format(parts[1], parts[3]), set()).add(parts[0])
+            mask = 0
+            for feature in split_features(parts[3]):
+                mask |= feature_bits.setdefault(feature, 1 << len(feature_bits))
+            tables['upos_feature_masks'].setdefault(parts[1], []).append((mask, parts[0]))
+    return tables
+
+
+def load_compiled_mapping(link):
+    # tables of the compiled mapping, None if it is missing or out of date (checked like the .conllup index, by size
+    # and, if touched, by the hash of the content)
+    try:
+        with open(compiled_mapping_filename(link), 'rb') as f:
+            data = pickle.load(f)
+        stat = os.stat(link)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+        return None
+
+    if not isinstance(data, dict) or data.get('version') != COMPILED_MAPPING_VERSION or data['size'] != stat.st_size:
+        return None
+    if data['mtime'] != stat.st_mtime_ns and data['sha1'] != file_hash(link):
+        return None
+    return data['tables']
+
+
+def save_compiled_mapping(link, tables):
+    # the compiled mapping is only an optimization, a read-only location is not an error
+    stat = os.stat(link)
+    filename = compiled_mapping_filename(link)
+    try:
+        with open('{}.tmp'.format(filename), 'wb') as f:
+            pickle.dump({'version': COMPILED_MAPPING_VERSION, 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                         'sha1': file_hash(link), 'tables': tables}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace('{}.tmp'.format(filename), filename)
+    except OSError:
+        pass
+
 
 class MSDMapper:
-    def __init__(self, link='mte5-udv2.mapping'):
-        self.msd_upos = {}
-        self.msd_mtefeat = {}
-        self.msd_udfeat = {}
-        self.uposudfeat_msd = {}
-        with open(link, 'r', encoding='utf-8') as mapfile:
-            for line in mapfile:
-                parts = line.strip().split('\t')
-                self.msd_upos[parts[0]] = parts[1]
-                self.msd_mtefeat[parts[0]] = parts[2]
-                self.msd_udfeat[parts[0]] = parts[3]
-                (self.uposudfeat_msd.get('{}|{}'.format(parts[1], parts[3]), set())).add(parts[0])
+    def __init__(self, link=DEFAULT_MAPPING, cache_size=CACHE_SIZE, rule_groups=RULE_GROUPS):
+        self.dispatch = compile_rules(rule_groups)
+        # lemmas and form predicates the rules of each category depend on, the reduced key of the cache
+        self.rule_lemmas = frozenset(lemma for group in rule_groups for r in group for lemma in r.lemmas or [])
+        self.form_predicates = {category: list(OrderedDict.fromkeys(r.form for group in groups for r in group
+                                                                    if r.form is not None))
+                                for category, groups in self.dispatch.items()}
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.link = link
+        self.loaded = False
+
+    def __getattr__(self, name):
+        # the mapping tables are loaded on first use
+        if name in MAPPING_TABLES and not self.loaded:
+            self.load()
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def load(self):
+        tables = load_compiled_mapping(self.link)
+        if tables is None:
+            tables = parse_mapping(self.link)
+            save_compiled_mapping(self.link, tables)
+        for name in MAPPING_TABLES:
+            setattr(self, name, tables[name])
+        self.loaded = True
+
+    def feature_mask(self, udfeat):
+        # bitmask of the features and the number of features the mapping does not know
+        mask = 0
+        unknown = 0
+        for feature in split_features(udfeat):
+            bit = self.feature_bits.get(feature)
+            if bit is None:
+                unknown += 1
+            else:
+                mask |= bit
+        return mask, unknown
+
+    def msds_with_features(self, upos, udfeat='_'):
+        # MSDs of the UPOS having (at least) all the features, in the order of the mapping
+        mask, unknown = self.feature_mask(udfeat)
+        if unknown:
+            return []
+        return [msd for msd_mask, msd in self.upos_feature_masks.get(upos, []) if msd_mask & mask == mask]
+
+    def suggest_msd(self, upos, udfeat, limit=5):
+        # MSDs mapped exactly to the UPOS and features, otherwise up to limit MSDs of the UPOS with the fewest
+        # features missing or added, sorted by that distance
+        exact = self.uposudfeat_msd.get('{}|{}'.format(upos, udfeat))
+        if exact:
+            return sorted(exact)
+        mask, unknown = self.feature_mask(udfeat)
+        candidates = sorted((bin(msd_mask ^ mask).count('1'), msd) for msd_mask, msd in
+                            self.upos_feature_masks.get(upos, []))
+        return [msd for distance, msd in candidates[:limit]]
+
+    def rules(self, msd):
+        return self.dispatch.get(msd[:1]) or self.dispatch[None]
 
     def map_word(self, surface_form, lemma, msd):
         mtefeat = self.msd_mtefeat.get(msd, '_')
         upos = self.msd_upos.get(msd, '_')
         udfeat = self.msd_udfeat.get(msd, '_')
 
-        # Pronouns and determiners
-        if msd.startswith('Pi') and lemma in ('čiji', 'nečiji', 'ničiji', 'svačiji', 'ičiji'):
-            udfeat = udfeat[0:udfeat.rfind('|')] + '|Poss=Yes|PronType=Int,Rel'
-        if msd.startswith('Ps'):
-            if lemma in ('naš', 'vaš', 'njihov'):
-                udfeat = udfeat[0:udfeat.find('Person')] + 'Number[psor]=Plur|' + udfeat[udfeat.find('Person'):]
-            elif lemma in ('moj', 'tvoj'):
-                udfeat = udfeat[0:udfeat.find('Person')] + 'Number[psor]=Sing|' + udfeat[udfeat.find('Person'):]
-            elif lemma == 'njegov':
-                udfeat = udfeat[0:udfeat.find('Number')] + 'Gender[psor]=Masc,Neut|' +\
-                         udfeat[udfeat.find('Number'):udfeat.find('Person')] + 'Number[psor]=Sing|' +\
-                         udfeat[udfeat.find('Person'):]
-            elif lemma in ('njen', 'njezin'):
-                udfeat = udfeat[0:udfeat.find('Number')] + 'Gender[psor]=Fem|' +\
-                         udfeat[udfeat.find('Number'):udfeat.find('Person')] + 'Number[psor]=Sing|' +\
-                         udfeat[udfeat.find('Person'):]
-        if msd.startswith('P'):
-            if lemma in ('svako', 'svatko', 'niko', 'nitko', 'neko', 'netko', 'iko', 'itko', 'svašta', 'ništa', 'išta',
-                         'nešto'):
-                upos = 'PRON'
-            if lemma in ('sav', 'svaki', 'svakakav', 'svačiji', 'nikakav', 'ničiji', 'neki', 'nekolik', 'nekakav',
-                         'nečiji', 'ikoji', 'ičiji', 'ikakav'):
-                upos = 'DET'
-            if lemma in ('sav', 'sve', 'svako', 'svatko', 'svaki', 'svašta', 'svakakav', 'svačiji'):
-                if 'PronType' in udfeat:
-                    udfeat = udfeat[0:udfeat.find('PronType')] + 'PronType=Tot'
-                else:
-                    udfeat += 'PronType=Tot'
-            elif lemma in ('niko', 'nitko', 'ništa', 'nikakav', 'ničiji'):
-                if 'PronType' in udfeat:
-                    udfeat = udfeat[0:udfeat.find('PronType')] + 'PronType=Neg'
-                else:
-                    udfeat += 'PronType=Neg'
-            elif lemma in ('neko', 'netko', 'nešto', 'neki', 'nekolik', 'nekakav', 'nečiji', 'iko', 'itko', 'išta',
-                           'ikoji', 'ičiji', 'ikakav', 'pokoji', 'štošta'):
-                if 'PronType' in udfeat:
-                    udfeat = udfeat[0:udfeat.find('PronType')] + 'PronType=Ind'
-                else:
-                    udfeat += '|PronType=Ind'
-
-        # Adverbs
-        if msd == 'Rr':
-            if surface_form.endswith('ći'):
-                udfeat = 'Tense=Pres|VerbForm=Conv'
-            elif surface_form.endswith('ši'):
-                udfeat = 'Tense=Past|VerbForm=Conv'
-        elif msd.startswith('Rg'):
-            if lemma in ('sad', 'sada', 'onda', 'tad', 'tada', 'onda', 'ovde', 'ovdje', 'onde', 'ondje', 'ovamo',
-                         'tamo', 'onamo', 'ovuda', 'tuda', 'onuda', 'ovako', 'tako', 'onako', 'tu', 'stoga', 'zato',
-                         'ovoliko', 'toliko', 'onoliko'):
-                udfeat += '|PronType=Dem'
-            elif lemma in ('gde', 'gdje', 'kud', 'kuda', 'kako', 'kad', 'kada', 'koliko', 'zašto', 'odakle', 'otkada'):
-                udfeat += '|PronType=Int,Rel'
-            elif lemma in ('nekad', 'nekada', 'ponekad', 'nekako', 'negde', 'negdje', 'nekud', 'nekuda', 'odnekud',
-                           'nekoliko', 'ikad', 'ikada', 'ikako', 'ikoliko'):
-                udfeat += '|PronType=Ind'
-            elif lemma in ('uvek', 'uvijek', 'svakako', 'svuda', 'posvuda', 'svugde', 'svugdje', 'svakako'):
-                udfeat += '|PronType=Tot'
-            elif lemma in ('nikad', 'nikada', 'nigde', 'nigdje', 'nikud', 'nikuda', 'nikad', 'nikada', 'nikako',
-                           'nikoliko'):
-                udfeat += '|PronType=Neg'
-
-        # Numbers
-        if msd.startswith('Mlc') and msd != 'Mlc':
-            if 'Number' not in udfeat:
-                if lemma == 'jedan':
-                    numstr = 'Sing'
-                else:
-                    numstr = 'Plur'
-                udfeat = udfeat[0:udfeat.find('NumType')] + 'Number=' + numstr + '|NumType=Card'
-        elif msd.startswith('Mlo'):
-            udfeat = udfeat[0:udfeat.find('Gender')] + 'Degree=Pos|' + udfeat[udfeat.find('Gender'):]
-
-        # Verbs
-        if msd.startswith('Va'):
-            if surface_form in ('nisam', 'nisi', 'nije', 'nismo', 'niste', 'nisu',
-                                'neću', 'nećeš', 'neće', 'nećemo', 'nećete', 'neće',
-                                'nemam', 'nemaš', 'nema', 'nemamo', 'nemate', 'nemaju',
-                                'nemoj', 'nemojmo', 'nemojte'):
-                udfeat = udfeat[0:udfeat.find('Tense')] + 'Polarity=Neg|' + udfeat[udfeat.find('Tense'):]
-
-        # Other
-        if '%' in surface_form or '$' in surface_form:
-            upos = 'SYM'
-            if re.search('[0-9]+', surface_form):
-                udfeat = 'NumType=Mult'
-            else:
-                udfeat = '_'
+        for group in self.rules(msd):
+            for r in group:
+                if r.matches(surface_form, lemma, msd):
+                    upos, udfeat = r.edit(upos, udfeat, surface_form, lemma)
+                    break
 
         return mtefeat, upos, udfeat
 
+    def reduced_key(self, surface_form, lemma, msd):
+        # the part of the input map_word actually depends on: the MSD, the lemma if some rule checks it and the
+        # results of the form predicates of the rules that can apply to the MSD
+        predicates = self.form_predicates.get(msd[:1]) or self.form_predicates[None]
+        return (msd, lemma if lemma in self.rule_lemmas else None,
+                tuple([predicate(surface_form) for predicate in predicates]))
+
+    def map_cached(self, surface_form, lemma, msd):
+        # same as map_word, memoized in a bounded LRU cache on the reduced input
+        key = self.reduced_key(surface_form, lemma, msd)
+        cache = self.cache
+        result = cache.get(key)
+        if result is None:
+            result = self.map_word(surface_form, lemma, msd)
+            cache[key] = result
+            if len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+        return result
+
+    def map_many(self, surface_forms, lemmas, msds):
+        # map_word for each triple of the sequences, returns the list of results
+        map_cached = self.map_cached
+        return [map_cached(surface_form, lemma, msd) for surface_form, lemma, msd in zip(surface_forms, lemmas, msds)]
+
     def map_file(self, infilename, outfilename):
         with open(infilename, 'r', encoding='utf-8') as infile:
             with open(outfilename, 'w', encoding='utf-8') as outfile:
                 for line in infile:
                     if '\t' in line:
                         parts = line.split('\t')
-                        mtefeat, upos, udfeat = self.map_word(parts[1], parts[2], parts[4])
+                        mtefeat, upos, udfeat = self.map_cached(parts[1], parts[2], parts[4])
                         outfile.write(
                             parts[0] + '\t' + parts[1] + '\t' + parts[4] + '\t' +
                             mtefeat + '\t' + upos + '\t' + udfeat + '\n'
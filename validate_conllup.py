@@ -1,24 +1,43 @@
 import argparse
-
-from generate_conllu import generate
-from io import StringIO
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
 import subprocess
+import sys
+import tempfile
+import time
+
+from bisect import bisect_right
+from collections import Counter
+from compressed_io import is_plain_file, STDIO
+from concurrent.futures import ThreadPoolExecutor
+from conllup_index import CONLLUPIndex, file_hash, SENTENCE_ID_RE
+from conllup_reader import CONLLUPMappedReader
+from conllup_stats import add_stats_arguments, run_with_stats, stage
+from generate_conllu import create_outputs, feed_batch, generate, open_source, shard_documents, STATUS_MARKS
+
 
+ANCHOR_RE = re.compile(r'^# (?:newdoc|sent_id)', re.M)
+ERROR_LINE_RE = re.compile(r'\[Line\s+(\d+)')
+ERROR_CLASS_RE = re.compile(r'\]: \[L\d+ (\w+)')
+SUMMARY_RE = re.compile(r'^(?:\*\*\* (?:PASSED|FAILED) \*\*\*|\w+ errors: \d+$)')
+SUPPRESSED_RE = re.compile(r'suppressing further errors', re.IGNORECASE)
 
-def main(args):
-    outfile = StringIO()
 
-    with open(args.input, 'r') as infile:
-        generate(infile, outfile)
+class ValidationTimeout(TimeoutError):
+    pass
 
-    outfile.seek(0)
 
+def validator_args(args):
     proc_args = ["python3", "ud-tools/validate.py"]
 
     if args.quiet:
         proc_args.extend(["--quiet"])
 
-    if args.max_err:
+    if args.max_err is not None:
         proc_args.extend(["--max-err", str(args.max_err)])
 
     if args.lang:
@@ -39,8 +58,434 @@ def main(args):
     if args.check_coref:
         proc_args.extend(["--coref"])
 
-    proc = subprocess.Popen(proc_args, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
-    outs, errs = proc.communicate(input=outfile.read().encode(), timeout=90)
+    return proc_args
+
+
+def feed_validator(stdin, write):
+    # runs write(stream) on a text stream over the stdin pipe of the validator and closes it, the pipe buffer bounds
+    # the memory used. A validator that stops reading (e.g. after --max-err errors) is not an error.
+    outfile = io.TextIOWrapper(stdin, encoding='utf-8')
+    try:
+        write(outfile)
+        outfile.flush()
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            outfile.close()
+        except BrokenPipeError:
+            pass
+
+
+def run_validators(proc_args, writes, timeout=None, capture=False):
+    # runs a validator for every write function, which generates its input in a writer thread, returns the exit
+    # statuses of the validators and their (stdout and stderr) outputs if captured, otherwise the output of the
+    # validators goes straight to ours
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with ThreadPoolExecutor(max_workers=2 * len(writes)) as executor:
+        procs = []
+        writers = []
+        outputs = []
+        for write in writes:
+            proc = subprocess.Popen(proc_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE if capture else None,
+                                    stderr=subprocess.STDOUT if capture else None)
+            procs.append(proc)
+            writers.append(executor.submit(feed_validator, proc.stdin, write))
+            # the output is read while the validators run, so that they never block on a full pipe
+            outputs.append(executor.submit(proc.stdout.read) if capture else None)
+        try:
+            returncodes = [proc.wait(timeout=None if deadline is None else max(0, deadline - time.monotonic()))
+                           for proc in procs]
+        except subprocess.TimeoutExpired:
+            for proc in procs:
+                proc.kill()
+                proc.wait()
+            for writer in writers:
+                writer.result()
+            raise ValidationTimeout('Validation timed out after {} seconds.'.format(timeout))
+        # errors of generating the input, e.g. an invalid token
+        for writer in writers:
+            writer.result()
+        return returncodes, [output.result().decode('utf-8') if output else None for output in outputs]
+
+
+class AnchorRecorder:
+    # text stream wrapper counting the written lines and recording the line numbers of the # newdoc and # sent_id
+    # lines, the output of generate is always written in whole lines
+    def __init__(self, stream):
+        self.stream = stream
+        self.lines = 0
+        self.anchors = []
+
+    def write(self, data):
+        lines = self.lines
+        position = 0
+        for match in ANCHOR_RE.finditer(data):
+            lines += data.count('\n', position, match.start())
+            position = match.start()
+            self.anchors.append(lines + 1)
+        self.lines += data.count('\n')
+        return self.stream.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class ShardLineMap:
+    # Maps line numbers of the .conllu generated from a shard back to the lines of the source. Without filters the
+    # k-th # newdoc or # sent_id line of the output comes from the k-th segment of the shard, which starts with such
+    # a line, and the lines of a segment are the source lines without the dropped status lines. Lines before the
+    # first of them come from the preamble of the source, without the # global.columns line.
+
+    def __init__(self, reader, preamble, segments, anchors):
+        self.reader = reader
+        self.preamble = preamble
+        self.segments = segments
+        self.anchors = anchors
+
+    def source_line(self, line):
+        anchor = bisect_right(self.anchors, line) - 1
+        if anchor < 0 and self.preamble is not None:
+            segment, offset, dropped = self.preamble, line - 1, STATUS_MARKS + ('# global.columns',)
+        elif self.segments and self.anchors:
+            anchor = min(max(anchor, 0), len(self.segments) - 1)
+            segment, offset, dropped = self.segments[anchor], line - self.anchors[anchor], STATUS_MARKS
+        else:
+            return line
+
+        kept = [line_no for line_no, text in enumerate(self.reader.read_lines(segment['offset'], segment['end']),
+                                                       segment['line'])
+                if not text.startswith(dropped)]
+        if not kept:
+            return segment['line']
+        return kept[min(max(offset, 0), len(kept) - 1)]
+
+
+def shard_segments(documents):
+    # blocks of the documents starting with a # newdoc or # sent_id line, in file order
+    segments = []
+    for document in documents:
+        sentences = document['sentences']
+        segments.append({'offset': document['offset'], 'line': document['line'],
+                         'end': sentences[0]['offset'] if sentences else document['end']})
+        segments.extend(sentences)
+    return segments
+
+
+def write_shard(reader, blocks, outfile):
+    # generates the .conllu of the blocks of the source like generate without any filters, returns the counts
+    outputs = create_outputs(outfile)
+    for block in blocks:
+        feed_batch(outputs, block['line'], reader.read_lines(block['offset'], block['end']))
+    return outputs[0].counts
+
+
+def cross_shard_errors(shards):
+    # errors of the checks spanning the whole file, which the validators of single shards cannot see: sentence ids
+    # repeated in another shard (repeats within a shard are reported by its validator). Shards are cut at document
+    # boundaries, so the # newdoc line and all sentences of a document are always validated together.
+    errors = []
+    first_shards = {}
+    for shard_no, documents in enumerate(shards):
+        for document in documents:
+            for sentence in document['sentences']:
+                if sentence['id'] is None:
+                    continue
+                if first_shards.setdefault(sentence['id'], shard_no) != shard_no:
+                    errors.append((sentence['line'], "[Line {} Sent {}]: [L2 Metadata non-unique-sent-id] Non-unique "
+                                                     "sent_id attribute '{}'.".format(sentence['line'], sentence['id'],
+                                                                                      sentence['id'])))
+    return errors
+
+
+def parse_report(output):
+    # (line number, message) pairs of the errors in the output of a validator, lines following an error are kept with
+    # it, the summary is left out and other lines get line number 0
+    errors = []
+    for text in output.splitlines():
+        match = ERROR_LINE_RE.search(text)
+        if match:
+            errors.append((int(match.group(1)), text))
+        elif SUMMARY_RE.match(text):
+            continue
+        elif errors:
+            errors[-1] = (errors[-1][0], '{}\n{}'.format(errors[-1][1], text))
+        else:
+            errors.append((0, text))
+    return errors
+
+
+def renumber(text, line):
+    # the error message with the line number replaced
+    match = ERROR_LINE_RE.search(text)
+    return text[:match.start(1)] + str(line) + text[match.end(1):]
+
+
+def merge_reports(outputs, line_maps):
+    # error messages of all validators with their line numbers mapped back to the source, as (source line, message)
+    # pairs
+    errors = []
+    for output, line_map in zip(outputs, line_maps):
+        for line, text in parse_report(output):
+            if line:
+                line = line_map.source_line(line)
+                text = renumber(text, line)
+            errors.append((line, text))
+    return errors
+
+
+def print_report(errors, max_err):
+    # the errors in the order of the source and a summary in the format of the validator
+    for line, text in errors[:max_err] if max_err else errors:
+        print(text, file=sys.stderr)
+    classes = Counter([match.group(1) for match in [ERROR_CLASS_RE.search(text) for line, text in errors] if match])
+    for name, count in sorted(classes.items()):
+        print('{} errors: {}'.format(name, count), file=sys.stderr)
+    if errors:
+        print('*** FAILED *** with {} errors'.format(sum(classes.values()) or len(errors)), file=sys.stderr)
+    else:
+        print('*** PASSED ***', file=sys.stderr)
+
+
+def validate_sharded(args, proc_args, stats=None):
+    # validates shards of whole documents of the source file in parallel and merges the reports of the validators
+    index = CONLLUPIndex.get(args.input)
+    shards = list(shard_documents(index.documents, args.jobs)) or [[]]
+    blocks = [[index.preamble()] + shards[0]] + shards[1:]
+    recorders = [AnchorRecorder(None) for _ in blocks]
+    counts = [None for _ in blocks]
+
+    with CONLLUPMappedReader(args.input) as reader:
+        def shard_writer(shard_no):
+            def write(outfile):
+                recorders[shard_no].stream = outfile
+                counts[shard_no] = write_shard(reader, blocks[shard_no], recorders[shard_no])
+            return write
+
+        returncodes, outputs = run_validators(proc_args, [shard_writer(i) for i in range(len(blocks))], args.timeout,
+                                              capture=True)
+        line_maps = [ShardLineMap(reader, index.preamble() if shard_no == 0 else None, shard_segments(documents),
+                                  recorder.anchors)
+                     for shard_no, (documents, recorder) in enumerate(zip(shards, recorders))]
+        errors = merge_reports(outputs, line_maps) + cross_shard_errors(shards)
+
+    errors.sort(key=lambda error: error[0])
+    if not args.quiet:
+        print_report(errors, args.max_err)
+
+    if stats is not None:
+        stats.count('shards', len(blocks))
+        stats.count('errors', len(errors))
+        for shard_counts in counts:
+            stats.update(shard_counts or {})
+    return 1 if errors or any(returncodes) else 0
+
+
+VALIDATION_CACHE_VERSION = 1
+VALIDATION_CACHE_EXTENSION = '.validation'
+VALIDATOR_SCRIPT = 'ud-tools/validate.py'
+VALIDATOR_DATA = 'ud-tools/data'
+
+
+def validation_cache_filename(source):
+    return '{}{}'.format(source, VALIDATION_CACHE_EXTENSION)
+
+
+def validator_version():
+    # hash of the validator script and the size and modification time of its data files
+    version = [file_hash(VALIDATOR_SCRIPT)]
+    if os.path.isdir(VALIDATOR_DATA):
+        for name in sorted(os.listdir(VALIDATOR_DATA)):
+            stat = os.stat(os.path.join(VALIDATOR_DATA, name))
+            version.append([name, stat.st_size, stat.st_mtime_ns])
+    return version
+
+
+def load_validation_cache(source, validator, options):
+    # errors of every validated sentence by the hash of its .conllu, empty if there is no cache or it was made by
+    # another validator or with other options
+    try:
+        with open(validation_cache_filename(source), 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if (data.get('version') != VALIDATION_CACHE_VERSION or data['validator'] != validator or
+            data['options'] != options):
+        return {}
+    return data['sentences']
+
+
+def save_validation_cache(source, validator, options, sentences):
+    filename = validation_cache_filename(source)
+    with open('{}.tmp'.format(filename), 'w') as f:
+        json.dump({
+            'version': VALIDATION_CACHE_VERSION,
+            'validator': validator,
+            'options': options,
+            'sentences': sentences
+        }, f)
+    os.replace('{}.tmp'.format(filename), filename)
+
+
+class SentenceCollector:
+    # Text stream splitting the generated .conllu into sentences, i.e. runs of lines up to and including a blank line.
+    # Sentences with a cached validation are only recorded, all others are written to the output stream. Every
+    # sentence is recorded as (hash, line number in the .conllu, line number in the output or None, sent_id, offset
+    # of the # sent_id line).
+
+    def __init__(self, output_stream, cache):
+        self.output_stream = output_stream
+        self.cache = cache
+        self.pending = ''
+        self.lines = []
+        self.line_no = 1
+        self.output_line_no = 1
+        self.sentences = []
+
+    def write(self, data):
+        lines = (self.pending + data).split('\n')
+        self.pending = lines.pop()
+        for line in lines:
+            self.lines.append(line)
+            if not line:
+                self.end_sentence()
+
+    def close(self):
+        if self.pending:
+            self.lines.append(self.pending)
+        if self.lines:
+            self.end_sentence()
+
+    def end_sentence(self):
+        text = '\n'.join(self.lines) + '\n'
+        sha1 = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        sentence_id = None
+        sentence_id_offset = None
+        for offset, line in enumerate(self.lines):
+            if line.startswith('# sent_id'):
+                sentence_id, sentence_id_offset = SENTENCE_ID_RE.search(line + '\n').group(0), offset
+                break
+
+        output_line_no = None
+        if sha1 not in self.cache:
+            output_line_no = self.output_line_no
+            self.output_stream.write(text)
+            self.output_line_no += len(self.lines)
+        self.sentences.append((sha1, self.line_no, output_line_no, sentence_id, sentence_id_offset))
+        self.line_no += len(self.lines)
+        self.lines = []
+
+
+def sentence_id_errors(sentences):
+    # sentence ids repeated anywhere in the .conllu, the only check of the validator spanning several sentences
+    errors = []
+    seen = set()
+    for sha1, line_no, output_line_no, sentence_id, sentence_id_offset in sentences:
+        if sentence_id is None:
+            continue
+        if sentence_id in seen:
+            line = line_no + sentence_id_offset
+            errors.append((line, "[Line {} Sent {}]: [L2 Metadata non-unique-sent-id] Non-unique sent_id attribute "
+                                 "'{}'.".format(line, sentence_id, sentence_id)))
+        seen.add(sentence_id)
+    return errors
+
+
+def validate_cached(args, stats=None):
+    # validates only the sentences whose .conllu changed since the previous run and replays the cached errors of all
+    # others, errors are reported with the line numbers of the whole .conllu like a validation without the cache
+    options = argparse.Namespace(**vars(args))
+    # all errors are needed to cache them, --quiet and --max-err only apply to the report
+    options.quiet = False
+    options.max_err = 0
+    proc_args = validator_args(options)
+    validator = validator_version()
+    cache = load_validation_cache(args.input, validator, proc_args)
+
+    with tempfile.TemporaryFile('w+', encoding='utf-8') as changed:
+        collector = SentenceCollector(changed, cache)
+        with open_source(args.input) as infile:
+            generate(infile, collector, stats=stats)
+        collector.close()
+        sentences = collector.sentences
+
+        validated = [sentence for sentence in sentences if sentence[2] is not None]
+        returncode = 0
+        reported = []
+        truncated = False
+        if validated:
+            changed.seek(0)
+            returncodes, outputs = run_validators(proc_args, [lambda outfile: shutil.copyfileobj(changed, outfile)],
+                                                  args.timeout, capture=True)
+            returncode = returncodes[0]
+            reported = parse_report(outputs[0])
+            truncated = SUPPRESSED_RE.search(outputs[0]) is not None
+
+    # errors of the validated sentences by their hash, with the line numbers relative to the sentence
+    starts = [sentence[2] for sentence in validated]
+    new_errors = {sentence[0]: [] for sentence in validated}
+    unplaced = []
+    for line, text in reported:
+        position = bisect_right(starts, line) - 1
+        if not line or position < 0 or 'non-unique-sent-id' in text:
+            # errors outside of sentences are not cached, repeated sentence ids are checked over the whole .conllu
+            if 'non-unique-sent-id' not in text:
+                unplaced.append((line, text))
+            continue
+        new_errors[validated[position][0]].append([line - starts[position], text])
+
+    errors = []
+    for sha1, line_no, output_line_no, sentence_id, sentence_id_offset in sentences:
+        for offset, text in cache[sha1] if output_line_no is None else new_errors[sha1]:
+            errors.append((line_no + offset, renumber(text, line_no + offset)))
+    errors.extend(unplaced)
+    errors.extend(sentence_id_errors(sentences))
+    errors.sort(key=lambda error: error[0])
+
+    if returncode and not reported:
+        # the validator failed without reporting any error, e.g. it crashed
+        errors.append((0, 'The validator exited with status {}.'.format(returncode)))
+    elif not unplaced and not truncated:
+        # a report the validator cut short at --max-err would be replayed as if it were complete
+        cache.update(new_errors)
+        save_validation_cache(args.input, validator, proc_args, {sentence[0]: cache[sentence[0]]
+                                                                 for sentence in sentences})
+
+    if not args.quiet:
+        print_report(errors, args.max_err)
+    if stats is not None:
+        stats.count('sentences_cached', len(sentences) - len(validated))
+        stats.count('sentences_validated', len(validated))
+        stats.count('errors', len(errors))
+    return 1 if errors else 0
+
+
+def validate(args, stats=None):
+    proc_args = validator_args(args)
+    with stage(stats, 'validate'):
+        if args.cache:
+            return validate_cached(args, stats)
+        if args.jobs > 1:
+            # --max-err applies to the merged report, the validators of the shards report all their errors
+            options = argparse.Namespace(**vars(args))
+            options.quiet = False
+            options.max_err = 0
+            return validate_sharded(args, validator_args(options), stats)
+
+        def write(outfile):
+            with open_source(args.input) as infile:
+                generate(infile, outfile, stats=stats)
+
+        returncodes, outputs = run_validators(proc_args, [write], args.timeout)
+        return returncodes[0]
+
+
+def main(args, stats=None):
+    try:
+        return validate(args, stats)
+    except ValidationTimeout as e:
+        print(e, file=sys.stderr)
+        return 1
 
 
 if __name__ == '__main__':
@@ -52,7 +497,11 @@ if __name__ == '__main__':
     io_group = parser.add_argument_group("Input / output options")
     io_group.add_argument('--quiet', dest="quiet", action="store_true", default=False, help='Do not print any error messages. Exit with 0 on pass, non-zero on fail.')
     io_group.add_argument('--max-err', action="store", type=int, default=20, help='How many errors to output before exiting? 0 for all. Default: %(default)d.')
-    io_group.add_argument('input', help='Path to the source .conllup file.')
+    io_group.add_argument('--timeout', type=float, default=None, help='Stop the validation after this many seconds. No limit by default.')
+    io_group.add_argument('-j', '--jobs', type=int, default=1, help='Validate shards of whole documents in this many validator processes at once and merge their reports (uses the index, requires an uncompressed source file).')
+    io_group.add_argument('--cache', action='store_true', help='Keep the errors of every sentence in a cache next to the source file and validate only the sentences whose .conllu changed since the previous run.')
+    io_group.add_argument('input', help='Path to the source .conllup file (compressed files are decompressed, - reads '
+                                        'from stdin).')
 
     list_group = parser.add_argument_group("Tag sets", "Options relevant to checking tag sets.")
     list_group.add_argument("--lang", action="store", required=True, default=None, help="Which langauge are we checking? If you specify this (as a two-letter code), the tags will be checked using the language-specific files in the data/ directory of the validator.")
@@ -67,5 +516,14 @@ if __name__ == '__main__':
 
     coref_group = parser.add_argument_group("Coreference / entity constraints", "Options for checking coreference and entity annotation.")
     coref_group.add_argument('--coref', action='store_true', default=False, dest='check_coref', help='Test coreference and entity-related annotation in MISC.')
+    add_stats_arguments(parser.add_argument_group("Instrumentation options"))
     args = parser.parse_args()
-    main(args)
+    if args.jobs < 1:
+        parser.error('argument -j/--jobs must be at least 1')
+    if args.jobs > 1 and not is_plain_file(args.input):
+        parser.error('argument -j/--jobs requires an uncompressed source file')
+    if args.cache and args.jobs > 1:
+        parser.error('argument --cache: not allowed with argument -j/--jobs')
+    if args.cache and args.input == STDIO:
+        parser.error('argument --cache requires a source file')
+    sys.exit(run_with_stats(main, args))